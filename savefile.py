@@ -1,15 +1,54 @@
 #! /usr/bin/env python
 
+from array import array
 import binascii
-from bisect import insort
 from cStringIO import StringIO
 import hashlib
-import json
+import heapq
+from itertools import imap, izip, repeat
 import math
-import optparse
-import random
+import os
+import re
+import signal
+import stat
 import struct
 import sys
+import time
+
+
+class LazyModule(object):
+
+    # Stands in for a module that isn't imported until it's first used, so
+    # commands that don't need it don't wait for it to load
+
+    def __init__(self, name):
+        self.__name = name
+
+    def __getattr__(self, attr):
+        module = __import__(self.__name)
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+glob = LazyModule("glob")
+json = LazyModule("json")
+lzo = LazyModule("lzo")
+multiprocessing = LazyModule("multiprocessing")
+optparse = LazyModule("optparse")
+random = LazyModule("random")
+socket = LazyModule("socket")
+SocketServer = LazyModule("SocketServer")
+threading = LazyModule("threading")
+
+# Modules that may not be installed, by name, once an import has been tried
+optional_modules = {}
+
+def optional_module(name):
+    if name not in optional_modules:
+        try:
+            optional_modules[name] = __import__(name)
+        except ImportError:
+            optional_modules[name] = None
+    return optional_modules[name]
 
 
 class BL2Error(Exception): pass
@@ -52,54 +91,61 @@ class ReadBitstream(object):
 
 class WriteBitstream(object):
 
+    # Bits collect in an integer and are only moved into the output buffer
+    # once at least this many are waiting
+    flush_bits = 256
+
     def __init__(self):
-        self.s = ""
-        self.byte = 0
-        self.i = 7
+        self.s = bytearray()
+        self.bits = 0
+        self.n = 0
+
+    def flush(self):
+        n = self.n
+        extra = n & 7
+        if n >= 8:
+            whole = self.bits >> extra
+            self.s += binascii.unhexlify("%0*x" % ((n >> 3) * 2, whole))
+            self.bits = self.bits &~ (whole << extra)
+            self.n = extra
 
     def write_bit(self, b):
-        i = self.i
-        byte = self.byte | (b << i)
-        if i == 0:
-            self.s += chr(byte)
-            self.byte = 0
-            self.i = 7
-        else:
-            self.byte = byte
-            self.i = i - 1
+        self.bits = (self.bits << 1) | b
+        self.n += 1
+        if self.n >= self.flush_bits:
+            self.flush()
 
     def write_bits(self, b, n):
-        s = self.s
-        byte = self.byte
-        i = self.i
-        while n >= (i + 1):
-            shift = n - (i + 1)
-            n = n - (i + 1)
-            byte = byte | (b >> shift)
-            b = b &~ (byte << shift)
-            s = s + chr(byte)
-            byte = 0
-            i = 7
-        if n > 0:
-            byte = byte | (b << (i + 1 - n))
-            i = i - n
-        self.s = s
-        self.byte = byte
-        self.i = i
+        self.bits = (self.bits << n) | b
+        self.n += n
+        if self.n >= self.flush_bits:
+            self.flush()
 
     def write_byte(self, b):
-        i = self.i
-        if i == 7:
-            self.s += chr(b)
-        else:
-            self.s += chr(self.byte | (b >> (7 - i)))
-            self.byte = (b << (i + 1)) & 0xff
+        self.write_bits(b, 8)
+
+    def write_codes(self, codes, lengths):
+        bits = self.bits
+        n = self.n
+        limit = self.flush_bits
+        for code, length in izip(codes, lengths):
+            bits = (bits << length) | code
+            n += length
+            if n >= limit:
+                self.bits = bits
+                self.n = n
+                self.flush()
+                bits = self.bits
+                n = self.n
+        self.bits = bits
+        self.n = n
 
     def getvalue(self):
-        if self.i != 7:
-            return self.s + chr(self.byte)
+        self.flush()
+        if self.n != 0:
+            return str(self.s) + chr((self.bits << (8 - self.n)) & 0xff)
         else:
-            return self.s
+            return str(self.s)
 
 
 def read_huffman_tree(b):
@@ -118,46 +164,157 @@ def write_huffman_tree(node, b):
         write_huffman_tree(node[1][0], b)
         write_huffman_tree(node[1][1], b)
 
-def make_huffman_tree(data):
+def byte_frequencies(data):
+    numpy = optional_module("numpy")
+    if numpy is not None:
+        counts = numpy.bincount(numpy.frombuffer(data, dtype=numpy.uint8), minlength=256)
+        return counts.tolist()
     frequencies = [0] * 256
-    for c in data:
-        frequencies[ord(c)] += 1
+    for c in bytearray(data):
+        frequencies[c] += 1
+    return frequencies
+
+def make_huffman_tree(data):
+    frequencies = byte_frequencies(data)
 
+    # Every node is distinct, so the heap hands them back in exactly the
+    # order a sorted list would
     nodes = [[f, i] for (i, f) in enumerate(frequencies) if f != 0]
-    nodes.sort()
+    heapq.heapify(nodes)
 
     while len(nodes) > 1:
-        l, r = nodes[: 2]
-        nodes = nodes[2: ]
-        insort(nodes, [l[0] + r[0], [l, r]])
+        l = heapq.heappop(nodes)
+        r = heapq.heappop(nodes)
+        heapq.heappush(nodes, [l[0] + r[0], [l, r]])
 
     return nodes[0]
 
-def invert_tree(node, code=0, bits=0):
-    if type(node[1]) is int:
-        return {chr(node[1]): (code, bits)}
-    else:
-        d = {}
-        d.update(invert_tree(node[1][0], code << 1, bits + 1))
-        d.update(invert_tree(node[1][1], (code << 1) | 1, bits + 1))
-        return d
+def huffman_code_table(tree):
+    codes = [0] * 256
+    lengths = [0] * 256
+    pending = [(tree, 0, 0)]
+    while pending:
+        node, code, bits = pending.pop()
+        if type(node[1]) is int:
+            codes[node[1]] = code
+            lengths[node[1]] = bits
+        else:
+            pending.append((node[1][0], code << 1, bits + 1))
+            pending.append((node[1][1], (code << 1) | 1, bits + 1))
+    return codes, lengths
+
+def flatten_huffman_tree(tree):
+    # Internal nodes are numbered from 0 (the root), and each is stored as a
+    # pair of children where leaves appear as ~symbol
+    nodes = []
+    pending = [(tree, None, 0)]
+    while pending:
+        node, parent, side = pending.pop()
+        if type(node[1]) is int:
+            nodes[parent][side] = ~node[1]
+            continue
+        if parent is not None:
+            nodes[parent][side] = len(nodes)
+        index = len(nodes)
+        nodes.append([0, 0])
+        pending.append((node[1][1], index, 1))
+        pending.append((node[1][0], index, 0))
+    return nodes
+
+def make_huffman_nibble_entry(nodes, k):
+    node = k >> 4
+    output = ""
+    for shift in (3, 2, 1, 0):
+        node = nodes[node][(k >> shift) & 1]
+        if node < 0:
+            output += chr(~node)
+            node = 0
+    return output, node << 4
+
+def make_huffman_table_entry(nodes, nibbles, k):
+    high = nibbles[k >> 4]
+    if high is None:
+        high = nibbles[k >> 4] = make_huffman_nibble_entry(nodes, k >> 4)
+    low = nibbles[high[1] | (k & 15)]
+    if low is None:
+        low = nibbles[high[1] | (k & 15)] = make_huffman_nibble_entry(nodes, high[1] | (k & 15))
+    return high[0] + low[0], low[1] << 4
 
 def huffman_decompress(tree, bitstream, size):
-    output = ""
-    while len(output) < size:
-        node = tree
-        while 1:
-            b = bitstream.read_bit()
-            node = node[1][b]
-            if type(node[1]) is int:
-                output += chr(node[1])
-                break
-    return output
+    if type(tree[1]) is int:
+        return chr(tree[1]) * size
+
+    # The table is indexed by (node << 8) | byte, and each entry holds the
+    # symbols decoded by feeding those eight bits in from that node along
+    # with the node it finishes at.  Entries are filled in as they are hit,
+    # from a smaller table of the same kind for four bits at a time.
+    nodes = flatten_huffman_tree(tree)
+    table = [None] * (len(nodes) << 8)
+    nibbles = [None] * (len(nodes) << 4)
+
+    s = bitstream.s
+    i = bitstream.i
+    output = []
+    state = 0
+    while i & 7:
+        node = nodes[state][(ord(s[i >> 3]) >> (7 - (i & 7))) & 1]
+        i = i + 1
+        if node < 0:
+            output.append(chr(~node))
+            node = 0
+        state = node
+    state = state << 8
+
+    produced = len(output)
+    p = i >> 3
+    while produced < size:
+        # No byte can decode to more than eight symbols, so this never reads
+        # much past the end of the compressed data
+        n = (size - produced + 7) >> 3
+        chunk = bytearray(s[p: p + n])
+        if not chunk:
+            break
+        p = p + len(chunk)
+        parts = []
+        for c in chunk:
+            k = state | c
+            entry = table[k]
+            if entry is None:
+                entry = table[k] = make_huffman_table_entry(nodes, nibbles, k)
+            parts.append(entry[0])
+            state = entry[1]
+        parts = "".join(parts)
+        produced = produced + len(parts)
+        output.append(parts)
+    bitstream.i = p << 3
+
+    return "".join(output)[: size]
+
+huffman_chunk_size = 16384
+
+def huffman_compress(table, data, bitstream):
+    # Each chunk of the payload is spelled out as a string of binary digits
+    # and handed over as a single code
+    bits = [
+        bin(code)[2: ].zfill(nbits) if nbits else ""
+        for (code, nbits) in izip(*table)
+    ]
+    for i in xrange(0, len(data), huffman_chunk_size):
+        chunk = "".join(map(bits.__getitem__, bytearray(data[i: i + huffman_chunk_size])))
+        if chunk:
+            bitstream.write_codes((int(chunk, 2), ), (len(chunk), ))
+
+def huffman_decode(data, size):
+    bitstream = ReadBitstream(data)
+    tree = read_huffman_tree(bitstream)
+    return huffman_decompress(tree, bitstream, size)
 
-def huffman_compress(encoding, data, bitstream):
-    for c in data:
-        code, nbits = encoding[c]
-        bitstream.write_bits(code, nbits)
+def huffman_encode(data):
+    bitstream = WriteBitstream()
+    tree = make_huffman_tree(data)
+    write_huffman_tree(tree, bitstream)
+    huffman_compress(huffman_code_table(tree), data, bitstream)
+    return bitstream.getvalue()
 
 
 item_sizes = (
@@ -165,40 +322,53 @@ item_sizes = (
     (8, 13, 20, 11, 7, 7, 17, 17, 17, 17, 17, 17, 17, 17, 17, 17, 17)
 )
 
+# The bit offset of each value in an item, for items and for weapons
+item_offsets = tuple(
+    tuple(sum(sizes[: i]) for i in xrange(len(sizes))) for sizes in item_sizes
+)
+
+# The shift and mask of each value for items of each (is_weapon, length),
+# with None for values that don't fit, which take up no bits at all
+item_unpack_tables = {}
+
+def item_unpack_table(is_weapon, length):
+    table = item_unpack_tables.get((is_weapon, length))
+    if table is None:
+        table = []
+        i = 0
+        for size in item_sizes[is_weapon]:
+            if i + size > length * 8:
+                table.append(None)
+                continue
+            table.append((i, (1 << size) - 1))
+            i = i + size
+        table = item_unpack_tables[(is_weapon, length)] = tuple(table)
+    return table
+
 def pack_item_values(is_weapon, values):
+    # The values are packed into one little endian integer, with any bits
+    # left in the last byte set
+    n = 0
     i = 0
-    bytes = [0] * 32
-    for value, size in zip(values, item_sizes[is_weapon]):
+    for value, offset, size in izip(values, item_offsets[is_weapon], item_sizes[is_weapon]):
         if value is None:
             break
-        j = i >> 3
-        value = value << (i & 7)
-        while value != 0:
-            bytes[j] |= value & 0xff
-            value = value >> 8
-            j = j + 1
-        i = i + size
+        n |= value << offset
+        i = offset + size
     if (i & 7) != 0:
-        value = 0xff << (i & 7)
-        bytes[i >> 3] |= (value & 0xff)
-    return "".join(map(chr, bytes[: (i + 7) >> 3]))
+        n |= (0xff << i) & (0xff << (i & ~7))
+    length = (i + 7) >> 3
+    if length == 0:
+        return ""
+    n &= (1 << (length * 8)) - 1
+    return binascii.unhexlify("%0*x" % (length * 2, n))[:: -1]
 
 def unpack_item_values(is_weapon, data):
-    i = 8
-    data = " " + data
-    values = []
-    end = len(data) * 8
-    for size in item_sizes[is_weapon]:
-        j = i + size
-        if j > end:
-            values.append(None)
-            continue
-        value = 0
-        for b in data[j >> 3: (i >> 3) - 1: -1]:
-            value = (value << 8) | ord(b)
-        values.append((value >> (i & 7)) &~ (0xff << size))
-        i = j
-    return values
+    table = item_unpack_table(is_weapon, len(data))
+    if not data:
+        return list(table)
+    n = int(binascii.hexlify(data[:: -1]), 16)
+    return [None if t is None else (n >> t[0]) & t[1] for t in table]
 
 def rotate_data_right(data, steps):
     steps = steps % len(data)
@@ -208,20 +378,88 @@ def rotate_data_left(data, steps):
     steps = steps % len(data)
     return data[steps: ] + data[: steps]
 
-def xor_data(data, key):
+def item_keystream(key, length):
+    # The bytes xor_data XORs data with, which for key 0 (used for every
+    # exported item) are all zero and kept from one call to the next
     key = key & 0xffffffff
-    output = ""
-    for c in data:
+    if key == 0:
+        stream = zero_keystream[0]
+        if len(stream) < length:
+            stream = zero_keystream[0] = "\x00" * length
+        return stream[: length]
+    stream = bytearray(length)
+    for i in xrange(length):
         key = (key * 279470273) % 4294967291
-        output += chr((ord(c) ^ key) & 0xff)
-    return output
+        stream[i] = key & 0xff
+    return str(stream)
+
+zero_keystream = ["\x00" * 64]
+
+def xor_strings(data, stream):
+    n = len(data)
+    if n == 0:
+        return ""
+    value = int(binascii.hexlify(data), 16) ^ int(binascii.hexlify(stream), 16)
+    return binascii.unhexlify("%0*x" % (n * 2, value))
+
+def xor_data(data, key):
+    if key & 0xffffffff == 0:
+        return data
+    return xor_strings(data, item_keystream(key, len(data)))
+
+keystream_multiplier = 279470273
+keystream_modulus = 4294967291
+keystream_powers = [keystream_multiplier]
+
+def keystream_power_table(length):
+    # The multiplier to the power of 1 to length, modulo the prime
+    powers = keystream_powers
+    while len(powers) < length:
+        powers.append(powers[-1] * keystream_multiplier % keystream_modulus)
+    return powers[: length]
+
+def split_strings(data, lengths):
+    strings = []
+    i = 0
+    for n in lengths:
+        strings.append(data[i: i + n])
+        i = i + n
+    return strings
+
+def xor_batch(datas, keys):
+    # Does xor_data for many strings at once.  The n-th keystream value for
+    # a key is key * multiplier ** n modulo the prime, so with numpy every
+    # keystream comes from one multiplication of the keys by a table of
+    # powers; without it they're generated in turn.  Either way they're
+    # applied to all of the data in one XOR.
+    datas = list(datas)
+    seeds = [key & 0xffffffff for key in keys]
+    if not any(seeds):
+        return datas
+    lengths = map(len, datas)
+    numpy = optional_module("numpy")
+    if numpy is not None:
+        width = max(lengths)
+        powers = numpy.array(keystream_power_table(width), dtype=numpy.uint64)
+        streams = numpy.array(seeds, dtype=numpy.uint64)[:, None] * powers[None, :]
+        streams = (streams % numpy.uint64(keystream_modulus)).astype(numpy.uint8)
+        buffer = numpy.frombuffer(
+            "".join(data.ljust(width, "\x00") for data in datas), dtype=numpy.uint8
+        )
+        output = (buffer.reshape(len(datas), width) ^ streams).tostring()
+        return [output[i * width: i * width + n] for (i, n) in enumerate(lengths)]
+    streams = "".join(imap(item_keystream, seeds, lengths))
+    return split_strings(xor_strings("".join(datas), streams), lengths)
+
+def item_checksum(header, item):
+    padding = "\xff" * (33 - len(item))
+    h = binascii.crc32(header + "\xff\xff" + item + padding) & 0xffffffff
+    return struct.pack(">H", ((h >> 16) ^ h) & 0xffff)
 
 def wrap_item(is_weapon, values, key):
     item = pack_item_values(is_weapon, values)
     header = struct.pack(">Bi", (is_weapon << 7) | 7, key)
-    padding = "\xff" * (33 - len(item))
-    h = binascii.crc32(header + "\xff\xff" + item + padding) & 0xffffffff
-    checksum = struct.pack(">H", ((h >> 16) ^ h) & 0xffff)
+    checksum = item_checksum(header, item)
     body = xor_data(rotate_data_left(checksum + item, key & 31), key >> 5)
     return header + body
 
@@ -231,16 +469,59 @@ def unwrap_item(data):
     raw = rotate_data_right(xor_data(data[5: ], key >> 5), key & 31)
     return is_weapon, unpack_item_values(is_weapon, raw[2: ]), key
 
+def wrap_items(items):
+    # wrap_item for a list of (is_weapon, values, key), with the keystreams
+    # done together
+    headers = []
+    bodies = []
+    for is_weapon, values, key in items:
+        item = pack_item_values(is_weapon, values)
+        header = struct.pack(">Bi", (is_weapon << 7) | 7, key)
+        headers.append(header)
+        bodies.append(rotate_data_left(item_checksum(header, item) + item, key & 31))
+    bodies = xor_batch(bodies, [key >> 5 for (is_weapon, values, key) in items])
+    return [header + body for (header, body) in izip(headers, bodies)]
+
+def unwrap_items(datas):
+    # unwrap_item for a list of items, with their keystreams done together
+    headers = [struct.unpack(">Bi", data[: 5]) for data in datas]
+    bodies = xor_batch([data[5: ] for data in datas], [key >> 5 for (v, key) in headers])
+    items = []
+    for (version_type, key), body in izip(headers, bodies):
+        is_weapon = version_type >> 7
+        raw = rotate_data_right(body, key & 31)
+        items.append((is_weapon, unpack_item_values(is_weapon, raw[2: ]), key))
+    return items
+
 def replace_raw_item_key(data, key):
+    # Key 0 doesn't rotate or change the body at all, so there's nothing to
+    # undo or apply for it, and otherwise each key costs one XOR
     old_key = struct.unpack(">i", data[1: 5])[0]
-    item = rotate_data_right(xor_data(data[5: ], old_key >> 5), old_key & 31)[2: ]
+    item = data[5: ]
+    if old_key != 0:
+        item = rotate_data_right(xor_data(item, old_key >> 5), old_key & 31)
+    item = item[2: ]
     header = data[0] + struct.pack(">i", key)
-    padding = "\xff" * (33 - len(item))
-    h = binascii.crc32(header + "\xff\xff" + item + padding) & 0xffffffff
-    checksum = struct.pack(">H", ((h >> 16) ^ h) & 0xffff)
-    body = xor_data(rotate_data_left(checksum + item, key & 31), key >> 5)
+    body = item_checksum(header, item) + item
+    if key != 0:
+        body = xor_data(rotate_data_left(body, key & 31), key >> 5)
     return header + body
 
+def replace_raw_item_keys(datas, keys):
+    # replace_raw_item_key for a list of items, with their keystreams (both
+    # the old ones and the new ones) done together
+    old_keys = [struct.unpack(">i", data[1: 5])[0] for data in datas]
+    bodies = xor_batch([data[5: ] for data in datas], [key >> 5 for key in old_keys])
+    headers = []
+    new_bodies = []
+    for data, body, old_key, key in izip(datas, bodies, old_keys, keys):
+        item = rotate_data_right(body, old_key & 31)[2: ]
+        header = data[0] + struct.pack(">i", key)
+        headers.append(header)
+        new_bodies.append(rotate_data_left(item_checksum(header, item) + item, key & 31))
+    new_bodies = xor_batch(new_bodies, [key >> 5 for key in keys])
+    return [header + body for (header, body) in izip(headers, new_bodies)]
+
 
 def read_varint(f):
     value = 0
@@ -259,16 +540,184 @@ def write_varint(f, i):
         i = i >> 7
     f.write(chr(i))
 
+class ProtobufEntries(object):
+
+    # All the values read for one field number, kept as a list of values
+    # and a string of wire types (one character each, so a single entry
+    # shares a cached string) instead of a list of [wire_type, value] lists.
+    # It still acts as such a list: indexing or iterating gives entries that
+    # read and write through to it, and lists can be assigned or appended.
+    # pairs() iterates over (wire_type, value) tuples directly.
+
+    __slots__ = ("wire_types", "values")
+
+    def __init__(self, entries=()):
+        self.wire_types = ""
+        self.values = []
+        for entry in entries:
+            self.append(entry)
+
+    @classmethod
+    def from_arrays(cls, wire_types, values):
+        entries = cls()
+        entries.wire_types = wire_types
+        entries.values = values
+        return entries
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i = i + len(self.values)
+        if not 0 <= i < len(self.values):
+            raise IndexError(i)
+        return ProtobufEntry(self, i)
+
+    def __setitem__(self, i, entry):
+        wire_type, value = entry
+        self.values[i] = value
+        self.set_wire_type(i, wire_type)
+
+    def __iter__(self):
+        return imap(ProtobufEntry, repeat(self), xrange(len(self.values)))
+
+    def __eq__(self, other):
+        return self.tolist() == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(self.tolist())
+
+    def append(self, entry):
+        wire_type, value = entry
+        self.wire_types += chr(wire_type)
+        self.values.append(value)
+
+    def extend(self, entries):
+        for entry in entries:
+            self.append(entry)
+
+    def wire_type(self, i):
+        return ord(self.wire_types[i])
+
+    def set_wire_type(self, i, wire_type):
+        if i < 0:
+            i = i + len(self.values)
+        w = self.wire_types
+        self.wire_types = w[: i] + chr(wire_type) + w[i + 1: ]
+
+    def pairs(self):
+        return izip(imap(ord, self.wire_types), self.values)
+
+    def tolist(self):
+        return map(list, self.pairs())
+
+class ProtobufEntry(object):
+
+    __slots__ = ("entries", "i")
+
+    def __init__(self, entries, i):
+        self.entries = entries
+        self.i = i
+
+    def __getitem__(self, j):
+        if j == 0 or j == -2:
+            return self.entries.wire_type(self.i)
+        elif j == 1 or j == -1:
+            return self.entries.values[self.i]
+        raise IndexError(j)
+
+    def __setitem__(self, j, value):
+        if j == 0 or j == -2:
+            self.entries.set_wire_type(self.i, value)
+        elif j == 1 or j == -1:
+            self.entries.values[self.i] = value
+        else:
+            raise IndexError(j)
+
+    def __len__(self):
+        return 2
+
+    def __iter__(self):
+        return iter((self.entries.wire_type(self.i), self.entries.values[self.i]))
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(list(self))
+
+def entry_pairs(entries):
+    if type(entries) is ProtobufEntries:
+        return entries.pairs()
+    return entries
+
+def entry_values(entries):
+    if type(entries) is ProtobufEntries:
+        return entries.values
+    return [entry[1] for entry in entries]
+
+def protobuf_json_default(value):
+    if type(value) is ProtobufEntries:
+        return value.tolist()
+    raise TypeError(repr(value) + " is not JSON serializable")
+
+def protobuf_json(data):
+    return json.dumps(
+        data, encoding="latin1", sort_keys=True, indent=4,
+        default=protobuf_json_default
+    )
+
+def parsed_json(player):
+    return protobuf_json(apply_structure(read_protobuf(player), save_structure))
+
 def read_protobuf(data):
-    fields = {}
+    wire_types = {}
+    values = {}
     end_position = len(data)
-    bytestream = StringIO(data)
-    while bytestream.tell() < end_position:
-        key = read_varint(bytestream)
+    i = 0
+    while i < end_position:
+        key = ord(data[i])
+        if key < 0x80:
+            i = i + 1
+        else:
+            key, i = read_varint_at(data, i)
         field_number = key >> 3
         wire_type = key & 7
-        value = read_protobuf_value(bytestream, wire_type)
-        fields.setdefault(field_number, []).append([wire_type, value])
+        if wire_type == 0:
+            value = ord(data[i])
+            if value < 0x80:
+                i = i + 1
+            else:
+                value, i = read_varint_at(data, i)
+        elif wire_type == 2:
+            length, i = read_varint_at(data, i)
+            value = data[i: i + length]
+            i = i + length
+        elif wire_type == 1:
+            value = struct.unpack_from("<Q", data, i)[0]
+            i = i + 8
+        elif wire_type == 5:
+            value = struct.unpack_from("<I", data, i)[0]
+            i = i + 4
+        else:
+            raise BL2Error("Unsupported wire type " + str(wire_type))
+        if field_number in values:
+            wire_types[field_number] += chr(wire_type)
+            values[field_number].append(value)
+        else:
+            wire_types[field_number] = chr(wire_type)
+            values[field_number] = [value]
+
+    fields = {}
+    for field_number, entries in values.iteritems():
+        fields[field_number] = ProtobufEntries.from_arrays(wire_types[field_number], entries)
     return fields
 
 def read_protobuf_value(b, wire_type):
@@ -292,24 +741,461 @@ def read_repeated_protobuf_value(data, wire_type):
         values.append(read_protobuf_value(b, wire_type))
     return values
 
+def read_varint_at(data, i):
+    value = 0
+    offset = 0
+    while 1:
+        b = ord(data[i])
+        i = i + 1
+        value |= (b & 0x7f) << offset
+        if (b & 0x80) == 0:
+            return value, i
+        offset = offset + 7
+
+def read_protobuf_value_at(data, wire_type, start, end):
+    if wire_type == 0:
+        return read_varint_at(data, start)[0]
+    elif wire_type == 1:
+        return struct.unpack_from("<Q", data, start)[0]
+    elif wire_type == 2:
+        return data[start: end]
+    else:
+        return struct.unpack_from("<I", data, start)[0]
+
+class LazyProtobuf(object):
+
+    # A message read in place from a string, which is shared with any nested
+    # messages taken from it rather than copied.  Only the offsets of each
+    # field are recorded, the first time any field is asked for, and values
+    # are decoded as they are fetched.
+
+    def __init__(self, data, start=0, end=None):
+        self.data = data
+        self.start = start
+        self.end = len(data) if end is None else end
+        self.offsets = None
+
+    def index(self):
+        if self.offsets is not None:
+            return self.offsets
+        data = self.data
+        offsets = {}
+        i = self.start
+        while i < self.end:
+            key, i = read_varint_at(data, i)
+            wire_type = key & 7
+            if wire_type == 0:
+                start = i
+                while ord(data[i]) & 0x80:
+                    i = i + 1
+                i = i + 1
+            elif wire_type == 1:
+                start = i
+                i = i + 8
+            elif wire_type == 2:
+                length, start = read_varint_at(data, i)
+                i = start + length
+            elif wire_type == 5:
+                start = i
+                i = i + 4
+            else:
+                raise BL2Error("Unsupported wire type " + str(wire_type))
+            offsets.setdefault(key >> 3, []).append((wire_type, start, i))
+        self.offsets = offsets
+        return offsets
+
+    def __contains__(self, field_number):
+        return field_number in self.index()
+
+    def keys(self):
+        return sorted(self.index().keys())
+
+    def count(self, field_number):
+        return len(self.index().get(field_number, ()))
+
+    def get(self, field_number, default=None):
+        entries = self.index().get(field_number)
+        if entries is None:
+            return default
+        values = ProtobufEntries()
+        for wire_type, start, end in entries:
+            values.append((wire_type, read_protobuf_value_at(self.data, wire_type, start, end)))
+        return values
+
+    def __getitem__(self, field_number):
+        entries = self.get(field_number)
+        if entries is None:
+            raise KeyError(field_number)
+        return entries
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def value(self, field_number, i=0):
+        wire_type, start, end = self.index()[field_number][i]
+        return read_protobuf_value_at(self.data, wire_type, start, end)
+
+    def message(self, field_number, i=0):
+        wire_type, start, end = self.index()[field_number][i]
+        return LazyProtobuf(self.data, start, end)
+
+    def messages(self, field_number):
+        return [
+            LazyProtobuf(self.data, start, end)
+            for (wire_type, start, end) in self.index().get(field_number, ())
+        ]
+
+    def repeated(self, field_number, wire_type, i=0):
+        data = self.data
+        start, end = self.index()[field_number][i][1: ]
+        values = []
+        while start < end:
+            if wire_type == 0:
+                value, start = read_varint_at(data, start)
+            elif wire_type == 1:
+                value = struct.unpack_from("<Q", data, start)[0]
+                start = start + 8
+            elif wire_type == 5:
+                value = struct.unpack_from("<I", data, start)[0]
+                start = start + 4
+            else:
+                raise BL2Error("Unsupported wire type " + str(wire_type))
+            values.append(value)
+        return values
+
+    def to_dict(self):
+        return dict(self.items())
+
+class EditableProtobuf(LazyProtobuf):
+
+    # A lazily read message that can be changed.  Fields that are assigned,
+    # or fetched with edit(), are encoded again when the message is written
+    # out, as are nested messages fetched with child() once they've been
+    # changed themselves; all other fields are copied from the original data.
+    # Replacing a field discards any changes made to its child messages.
+
+    def __init__(self, data, start=0, end=None):
+        LazyProtobuf.__init__(self, data, start, end)
+        self.changed = {}
+        self.children = {}
+
+    def dirty(self):
+        if self.changed:
+            return True
+        for child in self.children.itervalues():
+            if child.dirty():
+                return True
+        return False
+
+    def __contains__(self, field_number):
+        return field_number in self.changed or field_number in self.index()
+
+    def keys(self):
+        return sorted(set(self.index().keys()) | set(self.changed.keys()))
+
+    def count(self, field_number):
+        entries = self.changed.get(field_number)
+        if entries is not None:
+            return len(entries)
+        return LazyProtobuf.count(self, field_number)
+
+    def get(self, field_number, default=None):
+        entries = self.changed.get(field_number)
+        if entries is not None:
+            return entries
+        entries = LazyProtobuf.get(self, field_number)
+        if entries is None:
+            return default
+        for i in xrange(len(entries)):
+            child = self.children.get((field_number, i))
+            if child is not None and child.dirty():
+                entries.values[i] = child.getvalue()
+        return entries
+
+    def __setitem__(self, field_number, entries):
+        if type(entries) is not ProtobufEntries:
+            entries = ProtobufEntries(entries)
+        self.changed[field_number] = entries
+
+    def value(self, field_number, i=0):
+        if field_number in self.changed:
+            return self.changed[field_number].values[i]
+        child = self.children.get((field_number, i))
+        if child is not None and child.dirty():
+            return child.getvalue()
+        return LazyProtobuf.value(self, field_number, i)
+
+    def repeated(self, field_number, wire_type, i=0):
+        if field_number in self.changed:
+            value = self.changed[field_number].values[i]
+            if type(value) is list:
+                return list(value)
+            return read_repeated_protobuf_value(value, wire_type)
+        return LazyProtobuf.repeated(self, field_number, wire_type, i)
+
+    def edit(self, field_number):
+        entries = self.changed.get(field_number)
+        if entries is None:
+            entries = self.get(field_number, None)
+            if entries is None:
+                entries = ProtobufEntries()
+            self.changed[field_number] = entries
+        return entries
+
+    def child(self, field_number, i=0):
+        child = self.children.get((field_number, i))
+        if child is None:
+            wire_type, start, end = self.index()[field_number][i]
+            child = EditableProtobuf(self.data, start, end)
+            self.children[(field_number, i)] = child
+        return child
+
+    def child_messages(self, field_number):
+        return [self.child(field_number, i) for i in xrange(self.count(field_number))]
+
+    def getvalue(self):
+        if not self.dirty():
+            return self.data[self.start: self.end]
+        data = self.data
+        index = self.index()
+        children = self.children
+        parts = []
+        for field_number in self.keys():
+            entries = self.changed.get(field_number)
+            if entries is not None:
+                parts.append(write_protobuf({field_number: entries}))
+                continue
+            for i, (wire_type, start, end) in enumerate(index[field_number]):
+                child = children.get((field_number, i))
+                if child is not None and child.dirty():
+                    value = child.getvalue()
+                else:
+                    value = data[start: end]
+                parts.append(varint_bytes((field_number << 3) | wire_type))
+                if wire_type == 2:
+                    parts.append(varint_bytes(len(value)))
+                parts.append(value)
+        return "".join(parts)
+
+def patch_varints(data, patches, message=None):
+    # Changes varints directly in encoded protobuf data, given a list of
+    # (path, value).  Each path is a sequence of (field_number, i) steps
+    # through nested messages to the varint, and a last step of
+    # (field_number, i, j) names the j-th value in a packed repeated field.
+    # Only the length prefixes around the varints are rewritten as needed.
+    # A LazyProtobuf already read from the data can be passed in as message.
+    if message is None:
+        message = LazyProtobuf(data)
+    messages = {(): message}
+    edits = []
+    spans = {}
+    for path, value in patches:
+        message = messages[()]
+        parent = None
+        for depth in xrange(len(path)):
+            step = path[depth]
+            wire_type, start, end = message.index()[step[0]][step[1]]
+            if depth < len(path) - 1 or len(step) > 2:
+                if wire_type != 2:
+                    raise BL2Error("Field %d is not a message" % (step[0], ))
+                spans.setdefault(start, [end, 0, parent])
+                parent = start
+            elif wire_type != 0:
+                raise BL2Error("Field %d is not a varint" % (step[0], ))
+            if depth < len(path) - 1:
+                key = tuple(path[: depth + 1])
+                message = messages.get(key)
+                if message is None:
+                    message = messages[key] = LazyProtobuf(data, start, end)
+        if len(step) > 2:
+            for j in xrange(step[2] + 1):
+                if start >= end:
+                    raise BL2Error("Field %d has too few values" % (step[0], ))
+                value_start = start
+                start = read_varint_at(data, start)[1]
+            start, end = value_start, start
+        new = varint_bytes(value)
+        edits.append((start, end, new))
+        if parent is not None:
+            spans[parent][1] += len(new) - (end - start)
+
+    # Inner messages are shorter than the ones around them, so their change
+    # in size is known by the time the enclosing length prefix is written
+    for start, span in sorted(spans.items(), key=lambda (start, span): span[0] - start):
+        end, delta, parent = span
+        length = end - start
+        prefix_start = start - varint_size(length)
+        if read_varint_at(data, prefix_start) != (length, start):
+            raise BL2Error("Unexpected length encoding at offset %d" % (prefix_start, ))
+        new = varint_bytes(length + delta)
+        edits.append((prefix_start, start, new))
+        if parent is not None:
+            spans[parent][1] += delta + len(new) - (start - prefix_start)
+
+    parts = []
+    i = 0
+    for start, end, new in sorted(edits):
+        parts.append(data[i: start])
+        parts.append(new)
+        i = end
+    parts.append(data[i: ])
+    return "".join(parts)
+
 def write_protobuf(data):
-    b = StringIO()
+    # The size of every nested message and packed list is worked out first,
+    # so the whole message can then be written straight into one buffer
+    plan = []
+    size = measure_protobuf(data, plan)
+    b = bytearray(size)
+    write_protobuf_message(b, 0, plan, 0)
+    return str(b)
+
+def varint_size(i):
+    if i < 0x80:
+        return 1
+    elif i < 0x4000:
+        return 2
+    n = 3
+    i = i >> 21
+    while i:
+        n = n + 1
+        i = i >> 7
+    return n
+
+def protobuf_value_size(wire_type, value):
+    if wire_type == 0:
+        return varint_size(value)
+    elif wire_type == 1:
+        return 8
+    elif wire_type == 2:
+        return varint_size(len(value)) + len(value)
+    elif wire_type == 5:
+        return 4
+    else:
+        raise BL2Error("Unsupported wire type " + str(wire_type))
+
+def measure_protobuf(data, plan):
+    # Adds [sorted items, size] for this message and each nested one, and
+    # the size of each packed list, to plan in the order they're written
+    entry = [None, 0]
+    plan.append(entry)
     # If the data came from a JSON file the keys will all be strings
-    data = dict([(int(k), v) for (k, v) in data.items()])
-    for key, entries in sorted(data.items()):
-        for wire_type, value in entries:
-            if type(value) is dict:
-                value = write_protobuf(value)
-                wire_type = 2
-            elif type(value) in (list, tuple) and wire_type != 2:
-                sub_b = StringIO()
+    items = sorted(dict([(int(k), v) for (k, v) in data.items()]).items())
+    size = 0
+    for key, entries in items:
+        # The wire type never changes the size of the key
+        key_size = 1 if key < 16 else varint_size(key << 3)
+        for wire_type, value in entry_pairs(entries):
+            t = type(value)
+            if t is str and wire_type == 2:
+                n = len(value)
+                size = size + key_size + (1 if n < 0x80 else varint_size(n)) + n
+            elif t is int and wire_type == 0:
+                size = size + key_size + (1 if 0 <= value < 0x80 else varint_size(value))
+            elif t is dict:
+                n = measure_protobuf(value, plan)
+                size = size + key_size + varint_size(n) + n
+            elif (t is list or t is tuple) and wire_type != 2:
+                if wire_type == 0:
+                    n = sum(map(varint_size, value))
+                else:
+                    n = sum([protobuf_value_size(wire_type, v) for v in value])
+                plan.append(n)
+                size = size + key_size + varint_size(n) + n
+            else:
+                size = size + key_size + protobuf_value_size(wire_type, value)
+    entry[0] = items
+    entry[1] = size
+    return size
+
+def write_protobuf_message(b, i, plan, p):
+    # Keys, lengths and varints that fit in a single byte are written inline
+    items = plan[p][0]
+    p = p + 1
+    for key, entries in items:
+        key = key << 3
+        for wire_type, value in entry_pairs(entries):
+            t = type(value)
+            if t is str and wire_type == 2:
+                if key < 0x80:
+                    b[i] = key | 2
+                    i = i + 1
+                else:
+                    i = write_varint_into(b, i, key | 2)
+                n = len(value)
+                if n < 0x80:
+                    b[i] = n
+                    i = i + 1
+                else:
+                    i = write_varint_into(b, i, n)
+                b[i: i + n] = value
+                i = i + n
+            elif t is int and wire_type == 0:
+                if key < 0x80:
+                    b[i] = key
+                    i = i + 1
+                else:
+                    i = write_varint_into(b, i, key)
+                if 0 <= value < 0x80:
+                    b[i] = value
+                    i = i + 1
+                else:
+                    i = write_varint_into(b, i, value)
+            elif t is dict:
+                i = write_varint_into(b, i, key | 2)
+                i = write_varint_into(b, i, plan[p][1])
+                i, p = write_protobuf_message(b, i, plan, p)
+            elif (t is list or t is tuple) and wire_type != 2:
+                i = write_varint_into(b, i, key | 2)
+                i = write_varint_into(b, i, plan[p])
+                p = p + 1
                 for v in value:
-                    write_protobuf_value(sub_b, wire_type, v)
-                value = sub_b.getvalue()
-                wire_type = 2
-            write_varint(b, (key << 3) | wire_type)
-            write_protobuf_value(b, wire_type, value)
-    return b.getvalue()
+                    i = write_protobuf_value_into(b, i, wire_type, v)
+            else:
+                i = write_varint_into(b, i, key | wire_type)
+                i = write_protobuf_value_into(b, i, wire_type, value)
+    return i, p
+
+def varint_bytes(value):
+    if value < 0x80:
+        return chr(value)
+    b = bytearray(varint_size(value))
+    write_varint_into(b, 0, value)
+    return str(b)
+
+def write_varint_into(b, i, value):
+    if value < 0x80:
+        b[i] = value
+        return i + 1
+    elif value < 0x4000:
+        b[i] = 0x80 | (value & 0x7f)
+        b[i + 1] = value >> 7
+        return i + 2
+    while value > 0x7f:
+        b[i] = 0x80 | (value & 0x7f)
+        value = value >> 7
+        i = i + 1
+    b[i] = value
+    return i + 1
+
+def write_protobuf_value_into(b, i, wire_type, value):
+    if wire_type == 0:
+        return write_varint_into(b, i, value)
+    elif wire_type == 1:
+        struct.pack_into("<Q", b, i, value)
+        return i + 8
+    elif wire_type == 2:
+        if type(value) is unicode:
+            value = value.encode("latin1")
+        n = len(value)
+        i = write_varint_into(b, i, n)
+        b[i: i + n] = value
+        return i + n
+    elif wire_type == 5:
+        struct.pack_into("<I", b, i, value)
+        return i + 4
+    else:
+        raise BL2Error("Unsupported wire type " + str(wire_type))
 
 def write_protobuf_value(b, wire_type, value):
     if wire_type == 0:
@@ -342,86 +1228,28 @@ def parse_zigzag(i):
 
 
 def apply_structure(pbdata, s):
-    fields = {}
-    raw = {}
-    for k, data in pbdata.items():
-        mapping = s.get(k)
-        if mapping is None:
-            raw[k] = data
-            continue
-        elif type(mapping) is str:
-            fields[mapping] = data[0][1]
-            continue
-        key, repeated, child_s = mapping
-        if child_s is None:
-            values = [d[1] for d in data]
-            fields[key] = values if repeated else values[0]
-        elif type(child_s) is int:
-            if repeated:
-                fields[key] = read_repeated_protobuf_value(data[0][1], child_s)
-            else:
-                fields[key] = data[0][1]
-        elif type(child_s) is tuple:
-            values = [child_s[0](d[1]) for d in data]
-            fields[key] = values if repeated else values[0]
-        elif type(child_s) is dict:
-            values = [apply_structure(read_protobuf(d[1]), child_s) for d in data]
-            fields[key] = values if repeated else values[0]
-        else:
-            raise Exception("Invalid mapping %r for %r: %r" % (mapping, k, data))
-    if len(raw) != 0:
-        fields["_raw"] = {}
-        for k, values in raw.items():
-            safe_values = []
-            for (wire_type, v) in values:
-                if wire_type == 2:
-                    v = [ord(c) for c in v]
-                safe_values.append([wire_type, v])
-            fields["_raw"][k] = safe_values
-    return fields
+    return structure_codec(s)[0](pbdata)
+
+def safe_raw_fields(raw):
+    safe = {}
+    for k, values in raw.items():
+        safe_values = []
+        for (wire_type, v) in entry_pairs(values):
+            if wire_type == 2:
+                v = [ord(c) for c in v]
+            safe_values.append([wire_type, v])
+        safe[k] = safe_values
+    return safe
+
+# Encoders compiled by remove_structure, by id of the inverted structure
+# (along with it, as in compiled_structures)
+compiled_encoders = {}
 
 def remove_structure(data, inv):
-    pbdata = {}
-    pbdata.update(data.get("_raw", {}))
-    for k, value in data.items():
-        if k == "_raw":
-            continue
-        mapping = inv.get(k)
-        if mapping is None:
-            raise BL2Error("Unknown key %r in data" % (k, ))
-        elif type(mapping) is int:
-            pbdata[mapping] = [[guess_wire_type(value), value]]
-            continue
-        key, repeated, child_inv = mapping
-        if child_inv is None:
-            value = [value] if not repeated else value
-            pbdata[key] = [[guess_wire_type(v), v] for v in value]
-        elif type(child_inv) is int:
-            if repeated:
-                b = StringIO()
-                for v in value:
-                    write_protobuf_value(b, child_inv, v)
-                pbdata[key] = [[2, b.getvalue()]]
-            else:
-                pbdata[key] = [[child_inv, value]]
-        elif type(child_inv) is tuple:
-            value = [value] if not repeated else value
-            values = []
-            for v in map(child_inv[1], value):
-                if type(v) is list:
-                    values.append(v)
-                else:
-                    values.append([guess_wire_type(v), v])
-            pbdata[key] = values
-        elif type(child_inv) is dict:
-            value = [value] if not repeated else value
-            values = []
-            for d in [remove_structure(v, child_inv) for v in value]:
-                values.append([2, write_protobuf(d)])
-            pbdata[key] = values
-        else:
-            raise Exception("Invalid mapping %r for %r: %r" % (mapping, k, value))
-    return pbdata
+    compiled = compiled_encoders.get(id(inv))
+    if compiled is None:
+        compiled = compiled_encoders[id(inv)] = (inv, compile_structure_encoder(inv))
+    return compiled[1](data)
 
 def guess_wire_type(value):
     return 2 if isinstance(value, basestring) else 0
@@ -438,6 +1266,124 @@ def invert_structure(structure):
             inv[v] = k
     return inv
 
+# Structures compiled by structure_codec, by id (along with the structure
+# itself so the id can't be reused)
+compiled_structures = {}
+
+def structure_codec(structure):
+    # Returns functions turning protobuf data into readable data following
+    # the structure, and back, which are built the first time they're needed
+    compiled = compiled_structures.get(id(structure))
+    if compiled is None:
+        codec = (
+            compile_structure_decoder(structure),
+            compile_structure_encoder(invert_structure(structure))
+        )
+        compiled = compiled_structures[id(structure)] = (structure, codec)
+    return compiled[1]
+
+def first_value(data):
+    return entry_values(data)[0]
+
+def compile_field_decoder(mapping):
+    if type(mapping) is str:
+        return mapping, first_value
+    key, repeated, child_s = mapping
+    if child_s is None:
+        if repeated:
+            return key, lambda data: list(entry_values(data))
+        return key, first_value
+    elif type(child_s) is int:
+        if repeated:
+            return key, lambda data: read_repeated_protobuf_value(entry_values(data)[0], child_s)
+        return key, first_value
+    elif type(child_s) is tuple:
+        unwrap = child_s[0]
+        if repeated:
+            return key, lambda data: map(unwrap, entry_values(data))
+        return key, lambda data: unwrap(entry_values(data)[0])
+    elif type(child_s) is dict:
+        decode = compile_structure_decoder(child_s)
+        if repeated:
+            return key, lambda data: [decode(read_protobuf(d)) for d in entry_values(data)]
+        return key, lambda data: decode(read_protobuf(entry_values(data)[0]))
+    else:
+        raise Exception("Invalid mapping %r" % (mapping, ))
+
+def compile_structure_decoder(s):
+    decoders = dict((k, compile_field_decoder(mapping)) for (k, mapping) in s.items())
+
+    def decode(pbdata):
+        fields = {}
+        raw = None
+        for k, data in pbdata.iteritems():
+            decoder = decoders.get(k)
+            if decoder is None:
+                if raw is None:
+                    raw = {}
+                raw[k] = data
+            else:
+                fields[decoder[0]] = decoder[1](data)
+        if raw is not None:
+            fields["_raw"] = safe_raw_fields(raw)
+        return fields
+
+    return decode
+
+def guessed_entries(values):
+    return [[guess_wire_type(v), v] for v in values]
+
+def wrapped_entries(wrap, values):
+    entries = []
+    for v in map(wrap, values):
+        if type(v) is list:
+            entries.append(v)
+        else:
+            entries.append([guess_wire_type(v), v])
+    return entries
+
+def compile_field_encoder(mapping):
+    if type(mapping) is int:
+        return mapping, lambda value: [[guess_wire_type(value), value]]
+    key, repeated, child_inv = mapping
+    if child_inv is None:
+        if repeated:
+            return key, guessed_entries
+        return key, lambda value: guessed_entries([value])
+    elif type(child_inv) is int:
+        if repeated:
+            return key, lambda value: [[2, write_repeated_protobuf_value(value, child_inv)]]
+        return key, lambda value: [[child_inv, value]]
+    elif type(child_inv) is tuple:
+        wrap = child_inv[1]
+        if repeated:
+            return key, lambda value: wrapped_entries(wrap, value)
+        return key, lambda value: wrapped_entries(wrap, [value])
+    elif type(child_inv) is dict:
+        encode = compile_structure_encoder(child_inv)
+        if repeated:
+            return key, lambda value: [[2, write_protobuf(encode(v))] for v in value]
+        return key, lambda value: [[2, write_protobuf(encode(value))]]
+    else:
+        raise Exception("Invalid mapping %r" % (mapping, ))
+
+def compile_structure_encoder(inv):
+    encoders = dict((k, compile_field_encoder(mapping)) for (k, mapping) in inv.items())
+
+    def encode(data):
+        pbdata = {}
+        pbdata.update(data.get("_raw", {}))
+        for k, value in data.iteritems():
+            if k == "_raw":
+                continue
+            encoder = encoders.get(k)
+            if encoder is None:
+                raise BL2Error("Unknown key %r in data" % (k, ))
+            pbdata[encoder[0]] = encoder[1](value)
+        return pbdata
+
+    return encode
+
 def unwrap_bytes(value):
     return [ord(d) for d in value]
 
@@ -506,6 +1452,139 @@ def wrap_item_info(value):
             item.append((v["lib"] << bits) | v["asset"])
     return wrap_item(value["is_weapon"], item, value["key"])
 
+item_part_count = len(item_sizes[0]) - 6
+
+item_columns = (
+    ["save", "field", "is_weapon", "key", "set"] +
+    ["%s_%s" % (k, half) for (k, bits) in item_header_sizes[0] for half in ("lib", "asset")] +
+    ["level", "level2"] +
+    ["part%d_%s" % (i, half) for i in xrange(1, item_part_count + 1) for half in ("lib", "asset")]
+)
+
+class ItemTable(object):
+
+    # The bank and inventory items of any number of saves, decoded into an
+    # array per column (see item_columns) instead of a dict per item.  Any
+    # value an item is too short to hold is -1, as are both halves of parts
+    # it doesn't have.  With numpy, columns and masks are numpy arrays.
+
+    def __init__(self):
+        self.arrays = [array("i") for name in item_columns]
+        self.columns = dict(zip(item_columns, self.arrays))
+
+    @classmethod
+    def from_saves(cls, saves):
+        table = cls()
+        for i, data in enumerate(saves):
+            table.add_save(data, i)
+        return table
+
+    def __len__(self):
+        return len(self.arrays[0])
+
+    def add_save(self, data, save=0):
+        player = LazyProtobuf(unwrap_player_data(data))
+        for field_number in (41, 53, 54):
+            raws = [item.value(1) for item in player.messages(field_number)]
+            self.add_items(raws, save, field_number)
+
+    def add_item(self, data, save=0, field_number=0):
+        self.add_items([data], save, field_number)
+
+    def add_items(self, datas, save=0, field_number=0):
+        for item in unwrap_items(datas):
+            self.add_unwrapped_item(item, save, field_number)
+
+    def add_unwrapped_item(self, item, save=0, field_number=0):
+        is_weapon, values, key = item
+        row = [save, field_number, is_weapon, key, values[0]]
+        for (k, bits), value in zip(item_header_sizes[is_weapon], values[1: 4]):
+            row.extend(split_item_value(value, bits))
+        row.extend(values[4: 6])
+        bits = 10 + is_weapon
+        for value in values[6: ]:
+            row.extend(split_item_value(value, bits))
+        for column, value in izip(self.arrays, row):
+            column.append(-1 if value is None else value)
+
+    def column(self, name):
+        column = self.columns[name]
+        numpy = optional_module("numpy")
+        if numpy is not None:
+            if not column:
+                return numpy.zeros(0, dtype=numpy.int32)
+            return numpy.frombuffer(column.tostring(), dtype=numpy.int32)
+        return column
+
+    def row(self, i):
+        return dict((name, column[i]) for (name, column) in self.columns.items())
+
+    def mask(self, **criteria):
+        # Each criterion is a column name with a value to equal, a set or
+        # list of values to be one of, or a (low, high) inclusive range
+        numpy = optional_module("numpy")
+        if numpy is not None:
+            mask = numpy.ones(len(self), dtype=bool)
+            for name, test in criteria.items():
+                column = self.column(name)
+                if type(test) is tuple:
+                    mask &= (column >= test[0]) & (column <= test[1])
+                elif type(test) in (list, set, frozenset):
+                    mask &= numpy.in1d(column, list(test))
+                else:
+                    mask &= column == test
+            return mask
+        mask = [True] * len(self)
+        for name, test in criteria.items():
+            column = self.columns[name]
+            if type(test) is tuple:
+                low, high = test
+                mask = [m and low <= v <= high for (m, v) in izip(mask, column)]
+            elif type(test) in (list, set, frozenset):
+                test = set(test)
+                mask = [m and v in test for (m, v) in izip(mask, column)]
+            else:
+                mask = [m and v == test for (m, v) in izip(mask, column)]
+        return mask
+
+    def part_mask(self, lib=None, asset=None):
+        # Items with any part matching the given lib and asset
+        masks = []
+        for i in xrange(1, item_part_count + 1):
+            criteria = {}
+            if lib is not None:
+                criteria["part%d_lib" % i] = lib
+            if asset is not None:
+                criteria["part%d_asset" % i] = asset
+            masks.append(self.mask(**criteria))
+        numpy = optional_module("numpy")
+        if numpy is not None:
+            return numpy.logical_or.reduce(masks)
+        return map(any, izip(*masks))
+
+    def select(self, mask):
+        table = ItemTable()
+        numpy = optional_module("numpy")
+        if numpy is not None:
+            mask = numpy.asarray(mask, dtype=bool)
+            for name, column in table.columns.items():
+                column.fromstring(self.column(name)[mask].tostring())
+        else:
+            rows = [i for (i, m) in enumerate(mask) if m]
+            for name, column in table.columns.items():
+                values = self.columns[name]
+                column.extend([values[i] for i in rows])
+        return table
+
+    def filter(self, **criteria):
+        return self.select(self.mask(**criteria))
+
+def split_item_value(value, bits):
+    if value is None:
+        return -1, -1
+    lib = value >> bits
+    return lib, value &~ (lib << bits)
+
 save_structure = {
     1: "class",
     2: "level",
@@ -615,14 +1694,23 @@ save_structure = {
 }
 
 
-def unwrap_player_data(data):
+def unwrap_save_payload(data):
     if data[: 4] == "CON ":
         raise BL2Error("You need to use a program like Horizon or Modio to extract the SaveGame.sav file first")
 
     if data[: 20] != hashlib.sha1(data[20: ]).digest():
         raise BL2Error("Invalid save file")
 
-    data = lzo1x_decompress("\xf0" + data[20: ])
+    # The save only keeps the four size bytes of the LZO header, so the last
+    # byte of the hash stands in for the first header byte
+    size = struct.unpack(">I", data[20: 24])[0]
+    return get_codec("lzo")[0](memoryview(data)[19: ], size)
+
+def wrap_save_payload(data):
+    data = get_codec("lzo")[1](data)[1: ]
+    return hashlib.sha1(data).digest() + data
+
+def read_payload_header(data):
     size, wsg, version = struct.unpack(">I3sI", data[: 11])
     if version != 2 and version != 0x02000000:
         raise BL2Error("Unknown save version " + str(version))
@@ -631,10 +1719,25 @@ def unwrap_player_data(data):
         crc, size = struct.unpack(">II", data[11: 19])
     else:
         crc, size = struct.unpack("<II", data[11: 19])
+    return crc, size
 
-    bitstream = ReadBitstream(data[19: ])
-    tree = read_huffman_tree(bitstream)
-    player = huffman_decompress(tree, bitstream, size)
+def make_payload_header(length, crc, size, endian=1):
+    header = struct.pack(">I3s", length + 15, "WSG")
+    if endian == 1:
+        return header + struct.pack(">III", 2, crc, size)
+    else:
+        return header + struct.pack("<III", 2, crc, size)
+
+def unwrap_player_data(data):
+    if decode_cache is not None:
+        return decode_cache.player_data(data)
+    return decode_player_data(data)
+
+def decode_player_data(data):
+    data = unwrap_save_payload(data)
+    crc, size = read_payload_header(data)
+
+    player = get_codec("huffman")[0](data[19: ], size)
 
     if (binascii.crc32(player) & 0xffffffff) != crc:
         raise BL2Error("CRC check failed")
@@ -642,67 +1745,227 @@ def unwrap_player_data(data):
     return player
 
 def wrap_player_data(player, endian=1):
+    return wrap_encoded_player_data(player, get_codec("huffman")[1](player), endian)
+
+def wrap_encoded_player_data(player, encoded, endian=1):
+    # As wrap_player_data, with the player data already Huffman encoded
     crc = binascii.crc32(player) & 0xffffffff
 
-    bitstream = WriteBitstream()
-    tree = make_huffman_tree(player)
-    write_huffman_tree(tree, bitstream)
-    huffman_compress(invert_tree(tree), player, bitstream)
-    data = bitstream.getvalue() + "\x00\x00\x00\x00"
+    data = encoded + "\x00\x00\x00\x00"
+    header = make_payload_header(len(data), crc, len(player), endian)
+
+    return wrap_save_payload(header + data)
+
+class DecodeCache(object):
+
+    # Player data decoded from saves, kept in a directory under the SHA-1
+    # each save starts with (once it's been checked), so reading a save again
+    # skips LZO, Huffman and the CRC.  Files are touched whenever they're
+    # used, and the least recently used are removed once the total size of
+    # the directory passes max_size bytes.  The directory is only listed to
+    # find its size once, and again when the size kept since then (which
+    # doesn't include other processes' files) passes max_size, or after a
+    # sixteenth of max_size has been stored, to catch up with them.
+
+    def __init__(self, directory, max_size=256 << 20):
+        self.directory = directory
+        self.max_size = max_size
+        self.size = None
+        self.stored = 0
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+
+    def path(self, data, suffix):
+        if data[: 20] != hashlib.sha1(data[20: ]).digest():
+            return None
+        return os.path.join(self.directory, binascii.hexlify(data[: 20]) + suffix)
+
+    def load(self, path):
+        try:
+            value = open(path, "rb").read()
+            os.utime(path, None)
+        except (IOError, OSError):
+            return None
+        return value
 
-    header = struct.pack(">I3s", len(data) + 15, "WSG")
-    if endian == 1:
-        header = header + struct.pack(">III", 2, crc, len(player))
-    else:
-        header = header + struct.pack("<III", 2, crc, len(player))
+    def store(self, path, value):
+        # Written under another name first, so no process can read a file
+        # that's only partly written.  The cache only saves time, so failing
+        # to write to it (a full disk, or a directory that can't be written
+        # to) leaves the save to be decoded again next time.
+        temp = "%s.%d.tmp" % (path, os.getpid())
+        try:
+            f = open(temp, "wb")
+            try:
+                f.write(value)
+            finally:
+                f.close()
+            os.rename(temp, path)
+        except (IOError, OSError):
+            try:
+                os.remove(temp)
+            except OSError:
+                pass
+            return
+        self.stored = self.stored + len(value)
+        if self.size is not None:
+            self.size = self.size + len(value)
+        if self.size is None or self.size > self.max_size or self.stored > self.max_size >> 4:
+            self.evict()
+
+    def evict(self):
+        # Files still being written by store, in this process or another, are
+        # left alone, but ones that haven't changed for a minute were left
+        # behind by a process that was stopped part way through
+        now = time.time()
+        files = []
+        total = 0
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            total = total + st.st_size
+            if name.endswith(".tmp") and now - st.st_mtime < 60:
+                continue
+            files.append((st.st_mtime, st.st_size, path))
+        files.sort()
+        for mtime, size, path in files:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total = total - size
+        self.size = total
+        self.stored = 0
+
+    def player_data(self, data):
+        path = self.path(data, ".p")
+        if path is None:
+            return decode_player_data(data)
+        player = self.load(path)
+        if player is None:
+            player = decode_player_data(data)
+            self.store(path, player)
+        return player
+
+    def parsed_json(self, data):
+        # The JSON written for the player data after apply_structure with
+        # save_structure.  It's kept as the JSON itself, since the directory
+        # may be shared and reading it mustn't be able to run anything.
+        path = self.path(data, ".json")
+        if path is None:
+            return parsed_json(decode_player_data(data))
+        value = self.load(path)
+        if value is None:
+            value = parsed_json(self.player_data(data))
+            self.store(path, value)
+        return value
 
-    data = lzo1x_1_compress(header + data)[1: ]
+decode_cache = None
 
-    return hashlib.sha1(data).digest() + data
+def use_decode_cache(directory, max_size=256 << 20):
+    global decode_cache
+    cache = decode_cache
+    if cache is None or (cache.directory, cache.max_size) != (directory, max_size):
+        decode_cache = DecodeCache(directory, max_size)
+
+class SaveFile(object):
+
+    # A save game whose player data is read only as far as it's needed, and
+    # written out again by encoding only the fields that have been changed
 
+    def __init__(self, data=None, player=None):
+        if player is None:
+            player = unwrap_player_data(data)
+        self.player = EditableProtobuf(player)
+
+    def dirty(self):
+        return self.player.dirty()
+
+    def save(self, endian=1):
+        return wrap_player_data(self.player.getvalue(), endian)
+
+def convert_save(data, endian=1):
+    # Only the header says which platform a save is for, so the Huffman
+    # coded player data can be carried over untouched
+    data = unwrap_save_payload(data)
+    crc, size = read_payload_header(data)
+    header = make_payload_header(len(data) - 19, crc, size, endian)
+    return wrap_save_payload(header + data[19: ])
+
+
+nonzero_byte = re.compile("[^\x00]")
 
 def expand_zeroes(src, ip, extra):
-    start = ip
-    while src[ip] == 0:
-        ip = ip + 1
-    v = ((ip - start) * 255) + src[ip]
-    return v + extra, ip + 1
-
-def copy_earlier(b, offset, n):
-    i = len(b) - offset
-    end = i + n
-    while i < end:
-        chunk = b[i: i + n]
-        i = i + len(chunk)
-        n = n - len(chunk)
-        b.extend(chunk)
-
-def lzo1x_decompress(s):
-    dst = bytearray()
-    src = bytearray(s)
+    if src[ip] != 0:
+        return src[ip] + extra, ip + 1
+    end = nonzero_byte.search(src, ip).start()
+    v = ((end - ip) * 255) + src[end]
+    return v + extra, end + 1
+
+def copy_earlier(b, op, offset, n):
+    i = op - offset
+    if offset >= n:
+        b[op: op + n] = b[i: i + n]
+    else:
+        # The match overlaps the bytes it produces, so it repeats the last
+        # offset bytes over and over
+        b[op: op + n] = (b[i: op] * (n // offset + 1))[: n]
+    return op + n
+
+# No LZO1X data decompresses to more than this many times its length (each
+# zero byte extending a run adds 255 to it), so a larger size for it is wrong
+lzo_max_expansion = 256
+
+def lzo1x_decompress(s, size=None):
+    # The source is any buffer starting with the five byte LZO header (only
+    # skipped over here), and when the size of the output is known it is
+    # written into a buffer allocated up front rather than grown.  The size
+    # comes from the save, so it's only trusted as far as the data could
+    # decompress to, and the buffer grows past that if it has to.
+    src = s if type(s) is bytearray else bytearray(s)
+    view = memoryview(src)
+    if size is None:
+        dst = bytearray()
+    else:
+        dst = bytearray(min(size, len(src) * lzo_max_expansion))
     ip = 5
+    op = 0
 
     t = src[ip]; ip += 1
     if t > 17:
         t = t - 17
-        dst.extend(src[ip: ip + t]); ip += t
+        dst[op: op + t] = view[ip: ip + t]; ip += t; op += t
         t = src[ip]; ip += 1
     elif t < 16:
         if t == 0:
             t, ip = expand_zeroes(src, ip, 15)
-        dst.extend(src[ip: ip + t + 3]); ip += t + 3
+        t += 3
+        dst[op: op + t] = view[ip: ip + t]; ip += t; op += t
         t = src[ip]; ip += 1
 
     while 1:
         while 1:
             if t >= 64:
-                copy_earlier(dst, 1 + ((t >> 2) & 7) + (src[ip] << 3), (t >> 5) + 1); ip += 1
+                op = copy_earlier(dst, op, 1 + ((t >> 2) & 7) + (src[ip] << 3), (t >> 5) + 1); ip += 1
             elif t >= 32:
                 count = t & 31
                 if count == 0:
                     count, ip = expand_zeroes(src, ip, 31)
                 t = src[ip]
-                copy_earlier(dst, 1 + ((t | (src[ip + 1] << 8)) >> 2), count + 2); ip += 2
+                op = copy_earlier(dst, op, 1 + ((t | (src[ip + 1] << 8)) >> 2), count + 2); ip += 2
             elif t >= 16:
                 offset = (t & 8) << 11
                 count = t & 7
@@ -711,15 +1974,17 @@ def lzo1x_decompress(s):
                 t = src[ip]
                 offset += (t | (src[ip + 1] << 8)) >> 2; ip += 2
                 if offset == 0:
+                    if size is not None and op != size:
+                        raise BL2Error("Decompressed data is not the expected size")
                     return str(dst)
-                copy_earlier(dst, offset + 0x4000, count + 2)
+                op = copy_earlier(dst, op, offset + 0x4000, count + 2)
             else:
-                copy_earlier(dst, 1 + (t >> 2) + (src[ip] << 2), 2); ip += 1
+                op = copy_earlier(dst, op, 1 + (t >> 2) + (src[ip] << 2), 2); ip += 1
 
             t = t & 3
             if t == 0:
                 break
-            dst.extend(src[ip: ip + t]); ip += t
+            dst[op: op + t] = view[ip: ip + t]; ip += t; op += t
             t = src[ip]; ip += 1
 
         while 1:
@@ -727,22 +1992,24 @@ def lzo1x_decompress(s):
             if t < 16:
                 if t == 0:
                     t, ip = expand_zeroes(src, ip, 15)
-                dst.extend(src[ip: ip + t + 3]); ip += t + 3
+                t += 3
+                dst[op: op + t] = view[ip: ip + t]; ip += t; op += t
                 t = src[ip]; ip += 1
             if t < 16:
-                copy_earlier(dst, 1 + 0x0800 + (t >> 2) + (src[ip] << 2), 3); ip += 1
+                op = copy_earlier(dst, op, 1 + 0x0800 + (t >> 2) + (src[ip] << 2), 3); ip += 1
                 t = t & 3
                 if t == 0:
                     continue
-                dst.extend(src[ip: ip + t]); ip += t
+                dst[op: op + t] = view[ip: ip + t]; ip += t; op += t
                 t = src[ip]; ip += 1
             break
 
 
+read_le32 = struct.Struct("<I").unpack_from
+read_le256 = struct.Struct("<4Q").unpack_from
+
 def read_xor32(src, p1, p2):
-    v1 = src[p1] | (src[p1 + 1] << 8) | (src[p1 + 2] << 16) | (src[p1 + 3] << 24)
-    v2 = src[p2] | (src[p2 + 1] << 8) | (src[p2 + 2] << 16) | (src[p2 + 3] << 24)
-    return v1 ^ v2
+    return read_le32(src, p1)[0] ^ read_le32(src, p2)[0]
 
 clz_table = (
     32, 0, 1, 26, 2, 23, 27, 0, 3, 16, 24, 30, 28, 11, 0, 13, 4,
@@ -750,8 +2017,10 @@ clz_table = (
     20, 8, 19, 18
 )
 
+empty_lzo_dict = array("H", [0]) * 16384
+
 def lzo1x_1_compress_core(src, dst, ti, ip_start, ip_len):
-    dict_entries = [0] * 16384
+    dict_entries = array("H", empty_lzo_dict)
 
     in_end = ip_start + ip_len
     ip_end = ip_start + ip_len - 20
@@ -765,12 +2034,11 @@ def lzo1x_1_compress_core(src, dst, ti, ip_start, ip_len):
         while 1:
             if ip >= ip_end:
                 return in_end - (ii - ti)
-            dv = src[ip: ip + 4]
-            dindex = dv[0] | (dv[1] << 8) | (dv[2] << 16) | (dv[3] << 24)
-            dindex = ((0x1824429d * dindex) >> 18) & 0x3fff
+            dv = read_le32(src, ip)[0]
+            dindex = ((0x1824429d * dv) >> 18) & 0x3fff
             m_pos = ip_start + dict_entries[dindex]
             dict_entries[dindex] = (ip - ip_start) & 0xffff
-            if dv == src[m_pos: m_pos + 4]:
+            if dv == read_le32(src, m_pos)[0]:
                 break
             ip += 1 + ((ip - ii) >> 5)
 
@@ -799,6 +2067,12 @@ def lzo1x_1_compress_core(src, dst, ti, ip_start, ip_len):
         v = read_xor32(src, ip + m_len, m_pos + m_len)
         if v == 0:
             while 1:
+                # Eight of the four byte steps below at once, for as long as
+                # none of them could stop the match
+                if ip + m_len + 32 < ip_end and (
+                        read_le256(src, ip + m_len + 4) == read_le256(src, m_pos + m_len + 4)):
+                    m_len += 32
+                    continue
                 m_len += 4
                 v = read_xor32(src, ip + m_len, m_pos + m_len)
                 if ip + m_len >= ip_end:
@@ -886,26 +2160,207 @@ def lzo1x_1_compress(s):
     return str(dst)
 
 
+# Each kind of codec has a list of backends as (name, decompress, compress),
+# with the built-in pure Python one last.  The LZO functions take and give
+# data with the five byte header written by lzo1x_1_compress (the first byte
+# of which is never looked at when decompressing), and the Huffman functions
+# work on the bitstream starting with the tree.
+codec_backends = {
+    "lzo": [("builtin", lzo1x_decompress, lzo1x_1_compress)],
+    "huffman": [("builtin", huffman_decode, huffman_encode)],
+}
+selected_codecs = {}
+
+# Backends that use modules which may not be installed, as (kind, name,
+# module, decompress, compress), which are registered when a codec is first
+# needed if their module can be imported
+optional_codecs = []
+
+def make_codec_sample():
+    return "".join(
+        "GD_Sample.Part_%d:%s" % (i % 37, struct.pack("<I", (i * 2654435761) & 0xffffffff)[: i % 5])
+        for i in xrange(2000)
+    )
+
+def register_codec(kind, name, decompress, compress):
+    codec_backends[kind].insert(0, (name, decompress, compress))
+    selected_codecs.pop(kind, None)
+
+def register_optional_codecs():
+    while optional_codecs:
+        kind, name, module, decompress, compress = optional_codecs.pop(0)
+        if optional_module(module) is not None:
+            register_codec(kind, name, decompress, compress)
+
+def get_codec(kind):
+    codec = selected_codecs.get(kind)
+    if codec is None:
+        register_optional_codecs()
+        codec = selected_codecs[kind] = select_codec(kind)
+    return codec[1: ]
+
+def select_codec(kind):
+    backends = codec_backends[kind]
+    if len(backends) == 1:
+        return backends[0]
+
+    # Every backend has to round trip the sample, and read and write data
+    # the built-in backend can write and read, before the fastest is chosen
+    codec_sample = make_codec_sample()
+    builtin_decompress, builtin_compress = backends[-1][1: ]
+    builtin_data = builtin_compress(codec_sample)
+    best, best_time = backends[-1], None
+    for backend in backends:
+        name, decompress, compress = backend
+        try:
+            start = time.time()
+            data = compress(codec_sample)
+            output = decompress(data, len(codec_sample))
+            elapsed = time.time() - start
+            if output != codec_sample:
+                continue
+            if builtin_decompress(data, len(codec_sample)) != codec_sample:
+                continue
+            if decompress(builtin_data, len(codec_sample)) != codec_sample:
+                continue
+        except Exception:
+            continue
+        if best_time is None or elapsed < best_time:
+            best, best_time = backend, elapsed
+    return best
+
+def python_lzo_decompress(s, size=None):
+    # python-lzo allocates the size in the header before decompressing
+    if size is not None and size > len(s) * lzo_max_expansion:
+        raise BL2Error("Decompressed data is not the expected size")
+    return lzo.decompress("\xf0" + str(memoryview(s)[1: ]))
+
+def python_lzo_compress(s):
+    return lzo.compress(s, 1)
+
+optional_codecs.append(
+    ("lzo", "python-lzo", "lzo", python_lzo_decompress, python_lzo_compress)
+)
+
+
+# Changes modify_save can make by patching varints in place
+scalar_changes = ("level", "skillpoints", "money", "eridium", "seraph", "tokens")
+
+def level_experience(level):
+    lower = int(60 * (level ** 2.8) - 59.2)
+    upper = int(60 * ((level + 1) ** 2.8) - 59.2)
+    return lower, upper
+
+def scalar_patches(message, changes):
+    # The varints patch_varints has to change in the LazyProtobuf message to
+    # make these changes, or None if some of them aren't one varint each
+    index = message.index()
+    patches = []
+
+    def single(field_number, wire_type):
+        entries = index.get(field_number, ())
+        return len(entries) == 1 and entries[0][0] == wire_type
+
+    if changes.has_key("level"):
+        if not (single(2, 0) and single(3, 0)):
+            return None
+        level = int(changes["level"])
+        lower, upper = level_experience(level)
+        if not lower <= message.value(3) < upper:
+            patches.append((((3, 0), ), lower))
+        patches.append((((2, 0), ), level))
+
+    if changes.has_key("skillpoints"):
+        if not single(4, 0):
+            return None
+        patches.append((((4, 0), ), int(changes["skillpoints"])))
+
+    currencies = [
+        (name, j) for (name, j) in (("money", 0), ("eridium", 1), ("seraph", 2), ("tokens", 4))
+        if changes.has_key(name)
+    ]
+    if currencies:
+        if 6 not in index or index[6][0][0] != 2:
+            return None
+        count = len(message.repeated(6, 0))
+        for name, j in currencies:
+            if j >= count:
+                return None
+            patches.append((((6, 0, j), ), int(changes[name])))
+
+    return patches
+
+def transform_items(save, transform, predicate=None, fields=(41, 53, 54)):
+    # Calls transform(is_weapon, values) with the values of every item in
+    # the fields of a SaveFile (that predicate(is_weapon, values) is true
+    # for), for it to return new values.  Only the items whose values change
+    # are encoded again, with the keys they already had.  Returns the number
+    # of items changed.
+    player = save.player
+    messages = []
+    for field_number in fields:
+        messages.extend(player.child_messages(field_number))
+    changed = []
+    for message, item in izip(messages, unwrap_items([m.value(1) for m in messages])):
+        is_weapon, values, key = item
+        if predicate is not None and not predicate(is_weapon, values):
+            continue
+        new_values = transform(is_weapon, list(values))
+        if new_values != values:
+            changed.append((message, (is_weapon, new_values, key)))
+    raws = wrap_items([item for (message, item) in changed])
+    for (message, item), raw in izip(changed, raws):
+        message.edit(1)[0][1] = raw
+    return len(changed)
+
+def set_item_level(level):
+    def transform(is_weapon, values):
+        return values[: 4] + [level, level] + values[6: ]
+    return transform
+
+def set_item_header(name, lib, asset):
+    # Sets one of the values named in item_header_sizes, eg "manufacturer"
+    def transform(is_weapon, values):
+        for i, (k, bits) in enumerate(item_header_sizes[is_weapon]):
+            if k == name:
+                values[1 + i] = (lib << bits) | asset
+        return values
+    return transform
+
+def replace_item_part(old, new):
+    # Swaps any part given as (lib, asset) old for the part new
+    def transform(is_weapon, values):
+        bits = 10 + is_weapon
+        old_value = (old[0] << bits) | old[1]
+        new_value = (new[0] << bits) | new[1]
+        return values[: 6] + [new_value if v == old_value else v for v in values[6: ]]
+    return transform
+
 def modify_save(data, changes, endian=1):
-    player = read_protobuf(unwrap_player_data(data))
+    return wrap_player_data(modify_player_data(unwrap_player_data(data), changes), endian)
+
+def modify_player_data(player, changes):
+    if all(map(scalar_changes.__contains__, changes)):
+        message = LazyProtobuf(player)
+        patches = scalar_patches(message, changes)
+        if patches is not None:
+            return patch_varints(player, patches, message)
+
+    save = SaveFile(player=player)
+    player = save.player
 
     if changes.has_key("level"):
         level = int(changes["level"])
-        lower = int(60 * (level ** 2.8) - 59.2)
-        upper = int(60 * ((level + 1) ** 2.8) - 59.2)
-        if player[3][0][1] not in range(lower, upper):
-            player[3][0][1] = lower
+        lower, upper = level_experience(level)
+        if not lower <= player.value(3) < upper:
+            player.edit(3)[0][1] = lower
         player[2] = [[0, int(changes["level"])]]
 
     if changes.has_key("skillpoints"):
         player[4] = [[0, int(changes["skillpoints"])]]
 
     if any(map(changes.has_key, ("money", "eridium", "seraph", "tokens"))):
-        raw = player[6][0][1]
-        b = StringIO(raw)
-        values = []
-        while b.tell() < len(raw):
-            values.append(read_protobuf_value(b, 0))
+        values = player.repeated(6, 0)
         if changes.has_key("money"):
             values[0] = int(changes["money"])
         if changes.has_key("eridium"):
@@ -914,59 +2369,51 @@ def modify_save(data, changes, endian=1):
             values[2] = int(changes["seraph"])
         if changes.has_key("tokens"):
             values[4] = int(changes["tokens"])
-        player[6][0] = [0, values]
+        player.edit(6)[0] = [0, values]
 
     if changes.has_key("itemlevels"):
         if changes["itemlevels"]:
             level = int(changes["itemlevels"])
         else:
-            level = player[2][0][1]
-        for field_number in (53, 54):
-            for field in player[field_number]:
-                field_data = read_protobuf(field[1])
-                is_weapon, item, key = unwrap_item(field_data[1][0][1])
-                if item[4] > 1:
-                    item = item[: 4] + [level, level] + item[6: ]
-                    field_data[1][0][1] = wrap_item(is_weapon, item, key)
-                    field[1] = write_protobuf(field_data)
+            level = player.value(2)
+        transform_items(
+            save, set_item_level(level), lambda is_weapon, values: values[4] > 1, (53, 54)
+        )
 
     if changes.has_key("backpack"):
         size = int(changes["backpack"])
         sdus = int(math.ceil((size - 12) / 3.0))
         size = 12 + (sdus * 3)
-        slots = read_protobuf(player[13][0][1])
-        slots[1][0][1] = size
-        player[13][0][1] = write_protobuf(slots)
-        s = read_repeated_protobuf_value(player[36][0][1], 0)
-        player[36][0][1] = write_repeated_protobuf_value(s[: 7] + [sdus] + s[8: ], 0)
+        player.child(13).edit(1)[0][1] = size
+        s = player.repeated(36, 0)
+        player.edit(36)[0][1] = write_repeated_protobuf_value(s[: 7] + [sdus] + s[8: ], 0)
 
     if changes.has_key("bank"):
         size = int(changes["bank"])
         sdus = int(min(255, math.ceil((size - 6) / 2.0)))
         size = 6 + (sdus * 2)
-        if player.has_key(56):
-            player[56][0][1] = size
+        if 56 in player:
+            player.edit(56)[0][1] = size
         else:
             player[56] = [[0, size]]
-        s = read_repeated_protobuf_value(player[36][0][1], 0)
+        s = player.repeated(36, 0)
         if len(s) < 9:
             s = s + (9 - len(s)) * [0]
-        player[36][0][1] = write_repeated_protobuf_value(s[: 8] + [sdus] + s[9: ], 0)
+        player.edit(36)[0][1] = write_repeated_protobuf_value(s[: 8] + [sdus] + s[9: ], 0)
 
     if changes.get("gunslots", "0") in "234":
         n = int(changes["gunslots"])
-        slots = read_protobuf(player[13][0][1])
-        slots[2][0][1] = n
-        if slots[3][0][1] > n - 2:
-            slots[3][0][1] = n - 2
-        player[13][0][1] = write_protobuf(slots)
+        slots = player.child(13)
+        slots.edit(2)[0][1] = n
+        if slots.value(3) > n - 2:
+            slots.edit(3)[0][1] = n - 2
 
     if changes.has_key("unlocks"):
         unlocked, notifications = [], []
-        if player.has_key(23):
-            unlocked = map(ord, player[23][0][1])
-        if player.has_key(24):
-            notifications = map(ord, player[24][0][1])
+        if 23 in player:
+            unlocked = map(ord, player.value(23))
+        if 24 in player:
+            notifications = map(ord, player.value(24))
         unlocks = changes["unlocks"].split(":")
         if "slaughterdome" in unlocks:
             if 1 not in unlocked:
@@ -978,26 +2425,67 @@ def modify_save(data, changes, endian=1):
         if notifications:
             player[24] = [[2, "".join(map(chr, notifications))]]
         if "truevaulthunter" in unlocks:
-            if player[7][0][1] < 1:
-                player[7][0][1] = 1
-
-    return wrap_player_data(write_protobuf(player), endian)
+            if player.value(7) < 1:
+                player.edit(7)[0][1] = 1
+
+    return player.getvalue()
+
+def fan_out_save(data, variants, processes=1):
+    # modify_save for each of a list of (changes, endian), decoding the save
+    # only once.  Each set of changes is made to a separate view of the same
+    # player data, and variants with the same changes share the encoding.
+    player = unwrap_player_data(data)
+    keys = [tuple(sorted(changes.items())) for (changes, endian) in variants]
+    unique_keys = []
+    for key in keys:
+        if key not in unique_keys:
+            unique_keys.append(key)
+    jobs = [(player, dict(key)) for key in unique_keys]
+    if processes > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(processes, len(jobs)))
+        encoded = pool.map(encode_variant, jobs)
+        pool.close()
+        pool.join()
+    else:
+        encoded = map(encode_variant, jobs)
+    encoded = dict(zip(unique_keys, encoded))
+    return [
+        wrap_encoded_player_data(*encoded[key], endian=endian)
+        for (key, (changes, endian)) in izip(keys, variants)
+    ]
+
+def encode_variant(job):
+    player, changes = job
+    player = modify_player_data(player, changes)
+    return player, get_codec("huffman")[1](player)
+
+def parse_changes(modify):
+    changes = {}
+    for m in modify.split(","):
+        k, v = (m.split("=", 1) + [None])[: 2]
+        changes[k] = v
+    return changes
 
 def export_items(data, output):
-    player = read_protobuf(unwrap_player_data(data))
+    player = LazyProtobuf(unwrap_player_data(data))
     for i, name in ((41, "Bank"), (53, "Items"), (54, "Weapons")):
-        content = player.get(i)
-        if content is None:
+        if i not in player:
             continue
         print >>output, "; " + name
-        for field in content:
-            raw = read_protobuf(field[1])[1][0][1]
-            raw = replace_raw_item_key(raw, 0)
+        raws = [item.value(1) for item in player.messages(i)]
+        for raw in replace_raw_item_keys(raws, repeat(0, len(raws))):
             code = "BL2(" + raw.encode("base64").strip() + ")"
             print >>output, code
 
-def import_items(data, codelist, endian=1):
-    player = read_protobuf(unwrap_player_data(data))
+def import_items(data, codelist, endian=1, dedupe=False):
+    save = SaveFile(data)
+    player = save.player
+
+    # With dedupe, items already in the save or imported earlier are skipped,
+    # compared as they'd be exported, with key 0
+    if dedupe:
+        raws = [m.value(1) for f in (41, 53, 54) for m in player.messages(f)]
+        seen = set(replace_raw_item_keys(raws, repeat(0, len(raws))))
 
     to_bank = False
     for line in codelist.splitlines():
@@ -1018,6 +2506,12 @@ def import_items(data, codelist, endian=1):
         except binascii.Error:
             continue
 
+        if dedupe:
+            normalized = replace_raw_item_key(raw, 0)
+            if normalized in seen:
+                continue
+            seen.add(normalized)
+
         key = random.randrange(0x100000000) - 0x80000000
         raw = replace_raw_item_key(raw, key)
         if to_bank:
@@ -1030,9 +2524,9 @@ def import_items(data, codelist, endian=1):
             field = 53
             entry = {1: [[2, raw]], 2: [[0, 0]], 3: [[0, 1]]}
 
-        player.setdefault(field, []).append([2, write_protobuf(entry)])
+        player.edit(field).append([2, write_protobuf(entry)])
 
-    return wrap_player_data(write_protobuf(player), endian)
+    return save.save(endian)
 
 
 def parse_args():
@@ -1051,6 +2545,11 @@ def parse_args():
         "-i", "--import-items", metavar="FILENAME",
         help="read in codes for items and add them to the bank and inventory"
     )
+    p.add_option(
+        "--dedupe",
+        action="store_true",
+        help="when importing items, skip any already in the save or imported earlier"
+    )
     p.add_option(
         "-j", "--json",
         action="store_true",
@@ -1065,69 +2564,515 @@ def parse_args():
         "-m", "--modify", metavar="MODIFICATIONS",
         help="comma separated list of modifications to make, eg money=99999999,eridium=99"
     )
+    p.add_option(
+        "-v", "--variant", metavar="FILENAME=MODIFICATIONS",
+        action="append",
+        help="write a copy of the save with these modifications to FILENAME, which "
+             "can be given more than once to decode the save once for them all; "
+             "little-endian or big-endian in the list sets the format of the copy"
+    )
     p.add_option(
         "-p", "--parse",
         action="store_true",
         help="parse the protocol buffer data further and generate more readable JSON"
     )
+    p.add_option(
+        "-b", "--batch", metavar="DIRECTORY",
+        help="treat the arguments as directories or patterns of source files, and "
+             "write a file of the same name for each to this directory"
+    )
+    p.add_option(
+        "--watch", metavar="SECONDS", type="float",
+        help="in batch mode, keep checking the source files this often and "
+             "process each one again whenever it changes"
+    )
+    p.add_option(
+        "--processes", metavar="N", type="int",
+        help="number of processes to use in batch mode, by default one per CPU"
+    )
+    p.add_option(
+        "--cache", metavar="DIRECTORY",
+        help="keep the data decoded from each save in this directory, to skip "
+             "decompressing the same save again"
+    )
+    p.add_option(
+        "--cache-size", metavar="MEGABYTES", type="int", default=256,
+        help="how large the cache directory can grow, by default 256MB"
+    )
+    p.add_option(
+        "--serve", metavar="SOCKET",
+        help="keep running, and handle requests from --connect on this Unix socket"
+    )
+    p.add_option(
+        "--connect", metavar="SOCKET",
+        help="send the work to a server started with --serve on this Unix socket"
+    )
     return p.parse_args()
 
-def main(options, args):
+def process_save(data, options, itemlist=None):
+    # The output for one source file, given the command line options (and
+    # the item codes to import, if they're not to be read from the file)
+    if options.little_endian:
+        endian = 0
+    else:
+        endian = 1
+
+    if options.modify == "":
+        return convert_save(data, endian)
+    elif options.modify is not None:
+        return modify_save(data, parse_changes(options.modify), endian)
+    elif options.export_items:
+        output = StringIO()
+        export_items(data, output)
+        return output.getvalue()
+    elif options.import_items:
+        if itemlist is None:
+            itemlist = open(options.import_items, "r").read()
+        return import_items(data, itemlist, endian, options.dedupe)
+    elif options.decode:
+        if options.json and options.parse and decode_cache is not None:
+            return decode_cache.parsed_json(data)
+        player = unwrap_player_data(data)
+        if options.json and options.parse:
+            player = parsed_json(player)
+        elif options.json:
+            player = protobuf_json(read_protobuf(player))
+        return player
+    else:
+        player = data
+        if options.json:
+            data = json.loads(player, encoding="latin1")
+            if not data.has_key("1"):
+                data = structure_codec(save_structure)[1](data)
+            player = write_protobuf(data)
+        return wrap_player_data(player, endian)
+
+def batch_base(pattern):
+    # The directory a pattern's files are found under
+    if os.path.isdir(pattern):
+        return pattern
+    base = os.path.dirname(pattern)
+    while glob.has_magic(base):
+        base = os.path.dirname(base)
+    return base
+
+def common_directory(paths):
+    parts = os.path.commonprefix([path.split(os.sep) for path in paths])
+    return os.sep.join(parts) or os.sep
+
+def batch_sources(patterns):
+    # Returns each file the patterns match once, along with its path from
+    # the directory all of the patterns are under, which is what it's named
+    # in the batch directory.  Every profile has its own SaveNNNN.sav files,
+    # so going by the file name alone would write several saves to one file.
+    root = common_directory([os.path.abspath(batch_base(pattern)) for pattern in patterns])
+    seen = set()
+    sources = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            names = [os.path.join(pattern, name) for name in os.listdir(pattern)]
+        else:
+            names = glob.glob(pattern)
+        for name in sorted(name for name in names if os.path.isfile(name)):
+            path = os.path.realpath(name)
+            if path not in seen:
+                seen.add(path)
+                sources.append((name, os.path.relpath(os.path.abspath(name), root)))
+    return sources
+
+def batch_destination(name, directory, options):
+    if options.export_items:
+        name = name + ".txt"
+    return os.path.join(directory, name)
+
+def batch_jobs(sources, directory, options):
+    # Returns a job for process_batch_file per source, or None after listing
+    # any sources that would be written to the same file (which can only
+    # happen where file names aren't case sensitive)
+    jobs = []
+    written = {}
+    for source, name in sources:
+        destination = batch_destination(name, directory, options)
+        written.setdefault(os.path.normcase(destination), []).append(source)
+        jobs.append((source, destination, options))
+    conflicts = [names for names in written.values() if len(names) > 1]
+    for names in sorted(conflicts):
+        print >>sys.stderr, "These files would be written to the same file: %s" % (", ".join(names), )
+    if conflicts:
+        return None
+    return jobs
+
+def process_batch_file(job):
+    # Runs in the pool, so any error is returned as a message rather than
+    # stopping the whole batch
+    source, destination, options = job
+    try:
+        if options.cache:
+            use_decode_cache(options.cache, options.cache_size << 20)
+        if os.path.realpath(source) == os.path.realpath(destination):
+            raise BL2Error("Cannot overwrite the save file")
+        output = process_save(open(source, "rb").read(), options)
+        subdirectory = os.path.dirname(destination)
+        if not os.path.isdir(subdirectory):
+            try:
+                os.makedirs(subdirectory)
+            except OSError:
+                # Another process may have just made it
+                if not os.path.isdir(subdirectory):
+                    raise
+        open(destination, "wb").write(output)
+    except Exception, e:
+        return source, destination, "%s: %s" % (e.__class__.__name__, e)
+    return source, destination, None
+
+def process_batch(options, patterns):
+    directory = options.batch
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    jobs = batch_jobs(batch_sources(patterns), directory, options)
+    if jobs is None:
+        return 1
+
+    processes = options.processes or multiprocessing.cpu_count()
+    if processes > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(processes, len(jobs)))
+        results = pool.imap_unordered(process_batch_file, jobs)
+    else:
+        pool = None
+        results = imap(process_batch_file, jobs)
+
+    failures = report_batch_results(results)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if failures:
+        print >>sys.stderr, "%d of %d files failed" % (failures, len(jobs))
+    return failures
+
+def report_batch_results(results):
+    failures = 0
+    for source, destination, error in results:
+        if error is None:
+            print "%s -> %s" % (source, destination)
+        else:
+            failures = failures + 1
+            print >>sys.stderr, "%s: %s" % (source, error)
+        sys.stdout.flush()
+    return failures
+
+def ignore_interrupts():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def watch_batch(options, patterns):
+    # Checks the source files every options.watch seconds, reading only the
+    # SHA-1 at the start of each, and processes a file again once its hash
+    # has changed and then stayed the same until the next check
+    directory = options.batch
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    # Only the main process stops on ^C, and the workers are then ended
+    processes = options.processes or multiprocessing.cpu_count()
+    if processes > 1:
+        pool = multiprocessing.Pool(processes, ignore_interrupts)
+    else:
+        pool = None
+
+    processed = {}
+    pending = {}
+    try:
+        while 1:
+            jobs = []
+            all_jobs = batch_jobs(batch_sources(patterns), directory, options)
+            if all_jobs is None:
+                return 1
+            for job in all_jobs:
+                source = job[0]
+                try:
+                    digest = open(source, "rb").read(20)
+                except IOError:
+                    continue
+                if processed.get(source) == digest:
+                    pending.pop(source, None)
+                elif pending.get(source) != digest:
+                    pending[source] = digest
+                else:
+                    del pending[source]
+                    processed[source] = digest
+                    jobs.append(job)
+            if pool is not None and len(jobs) > 1:
+                report_batch_results(pool.imap_unordered(process_batch_file, jobs))
+            else:
+                report_batch_results(imap(process_batch_file, jobs))
+            time.sleep(options.watch)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+# The options a client passes on to the server with each request
+server_options = (
+    "decode", "dedupe", "export_items", "import_items", "json", "little_endian",
+    "modify", "parse"
+)
+
+# The largest frames the server reads, of options, a save (or its player
+# data as JSON, which is around forty times the size of the save) and item
+# codes to import
+max_options_frame = 64 << 10
+max_save_frame = 16 << 20
+max_itemlist_frame = 1 << 20
+
+def read_frame(f, limit=None):
+    header = f.read(4)
+    if len(header) < 4:
+        raise BL2Error("Connection closed")
+    n = struct.unpack(">I", header)[0]
+    if limit is not None and n > limit:
+        raise BL2Error("The request is too large")
+    data = f.read(n)
+    if len(data) < n:
+        raise BL2Error("Connection closed")
+    return data
+
+def write_frames(f, frames):
+    for frame in frames:
+        f.write(struct.pack(">I", len(frame)))
+        f.write(frame)
+    f.flush()
+
+def serve_request(request):
+    # Runs in the pool, so any error is returned as a message
+    options, data, itemlist = request
+    try:
+        return "ok", process_save(data, optparse.Values(options), itemlist)
+    except Exception, e:
+        return "error", "%s: %s" % (e.__class__.__name__, e)
+
+def start_server_worker(cache, cache_size):
+    ignore_interrupts()
+    if cache:
+        use_decode_cache(cache, cache_size << 20)
+    get_codec("lzo")
+    get_codec("huffman")
+
+def handle_save_request(handler):
+    # Each request is three frames, of the options as JSON, the save and the
+    # item codes to import, and is answered with two, of "ok" and the output
+    # or "error" and a message.  Only the options are read before a slot is
+    # taken, so a busy server never holds more than one save per slot.
+    try:
+        options = json.loads(read_frame(handler.rfile, max_options_frame))
+        options = dict((str(k), options.get(k)) for k in server_options)
+    except (BL2Error, ValueError, AttributeError, socket.error):
+        return
+    if not handler.server.slots.acquire(False):
+        send_reply(handler, ("error", "The server is busy"))
+        return
+    try:
+        try:
+            data = read_frame(handler.rfile, max_save_frame)
+            itemlist = read_frame(handler.rfile, max_itemlist_frame)
+        except socket.error:
+            return
+        except BL2Error, e:
+            send_reply(handler, ("error", str(e)))
+            return
+        response = handler.server.pool.apply(serve_request, ((options, data, itemlist), ))
+    finally:
+        handler.server.slots.release()
+    send_reply(handler, response)
+
+def send_reply(handler, frames):
+    # Sent straight to the socket, so that if the client has gone away
+    # nothing is left buffered to fail again when the handler finishes
+    reply = StringIO()
+    write_frames(reply, frames)
+    try:
+        handler.request.sendall(reply.getvalue())
+    except socket.error:
+        pass
+
+def make_save_server(path):
+    # The classes are only made here so SocketServer needn't be imported
+    # by every other command
+    class SaveRequestHandler(SocketServer.StreamRequestHandler):
+        # Clients that stop sending don't keep their threads for long
+        timeout = 60
+        handle = handle_save_request
+
+    class SaveServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+        daemon_threads = True
+
+    return SaveServer(path, SaveRequestHandler)
+
+def stale_socket(path):
+    # Whether path is a socket that no server is listening on any more
+    try:
+        mode = os.lstat(path).st_mode
+    except OSError:
+        return False
+    if not stat.S_ISSOCK(mode):
+        return False
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+    except socket.error:
+        return True
+    finally:
+        client.close()
+    return False
+
+def stop_server(signum, frame):
+    raise KeyboardInterrupt
+
+def serve(options):
+    # Handles requests from clients started with --connect on a Unix socket,
+    # in a pool of processes that each keep their codecs ready, turning
+    # requests away while there are already four per process to handle
+    path = options.serve
+    if os.path.lexists(path):
+        if not stale_socket(path):
+            print >>sys.stderr, "%s already exists, and isn't the socket of a server that has stopped" % (path, )
+            return 1
+        os.remove(path)
+    processes = options.processes or multiprocessing.cpu_count()
+    server = make_save_server(path)
+    server.pool = multiprocessing.Pool(
+        processes, start_server_worker, (options.cache, options.cache_size)
+    )
+    server.slots = threading.BoundedSemaphore(processes * 4)
+    signal.signal(signal.SIGTERM, stop_server)
+    print >>sys.stderr, "Serving on %s with %d processes" % (path, processes)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(path)
+        # Workers that were sent the same signal can leave the pool unable
+        # to shut down, so it's only given a few seconds to
+        stopping = threading.Thread(target=server.pool.terminate)
+        stopping.daemon = True
+        stopping.start()
+        stopping.join(5)
+
+def connect(options, args):
     if len(args) >= 2 and args[0] != "-" and args[0] == args[1]:
         print >>sys.stderr, "Cannot overwrite the save file, please use a different filename for the new save"
         return
 
     if len(args) < 1 or args[0] == "-":
-        input = sys.stdin
+        data = sys.stdin.read()
     else:
-        input = open(args[0], "rb")
+        data = open(args[0], "rb").read()
 
-    if len(args) < 2 or args[1] == "-":
+    itemlist = ""
+    if options.import_items:
+        itemlist = open(options.import_items, "r").read()
+
+    request = dict((k, getattr(options, k)) for k in server_options)
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.connect(options.connect)
+    frames = StringIO()
+    write_frames(frames, (json.dumps(request), data, itemlist))
+    try:
+        s.sendall(frames.getvalue())
+    except socket.error:
+        # The server stops reading a request it turns away, but still
+        # says why
+        pass
+    f = s.makefile("rb")
+    status = read_frame(f)
+    response = read_frame(f)
+    f.close()
+    s.close()
+
+    if status != "ok":
+        print >>sys.stderr, response
+        return 1
+
+    if options.export_items:
+        output = open(options.export_items, "w")
+    elif len(args) < 2 or args[1] == "-":
         output = sys.stdout
     else:
         output = open(args[1], "wb")
+    output.write(response)
 
+def process_variants(options, args):
     if options.little_endian:
         endian = 0
     else:
         endian = 1
 
-    if options.modify is not None:
-        changes = {}
-        if options.modify:
-            for m in options.modify.split(","):
-                k, v = (m.split("=", 1) + [None])[: 2]
-                changes[k] = v
-        output.write(modify_save(input.read(), changes, endian))
-    elif options.export_items:
-        output = open(options.export_items, "w")
-        export_items(input.read(), output)
-    elif options.import_items:
-        itemlist = open(options.import_items, "r")
-        output.write(import_items(input.read(), itemlist.read(), endian))
-    elif options.decode:
-        savegame = input.read()
-        player = unwrap_player_data(savegame)
-        if options.json:
-            data = read_protobuf(player)
-            if options.parse:
-                data = apply_structure(data, save_structure)
-            player = json.dumps(data, encoding="latin1", sort_keys=True, indent=4)
-        output.write(player)
+    filenames = []
+    variants = []
+    for variant in options.variant:
+        filename, modify = (variant.split("=", 1) + [""])[: 2]
+        changes = parse_changes(modify) if modify else {}
+        variant_endian = endian
+        if changes.has_key("little-endian"):
+            del changes["little-endian"]
+            variant_endian = 0
+        if changes.has_key("big-endian"):
+            del changes["big-endian"]
+            variant_endian = 1
+        filenames.append(filename)
+        variants.append((changes, variant_endian))
+
+    if len(args) < 1 or args[0] == "-":
+        data = sys.stdin.read()
     else:
-        player = input.read()
-        if options.json:
-            data = json.loads(player, encoding="latin1")
-            if not data.has_key("1"):
-                data = remove_structure(data, invert_structure(save_structure))
-            player = write_protobuf(data)
-        savegame = wrap_player_data(player, endian)
-        output.write(savegame)
+        data = open(args[0], "rb").read()
+        if args[0] in filenames:
+            print >>sys.stderr, "Cannot overwrite the save file, please use a different filename for the new save"
+            return
+
+    outputs = fan_out_save(data, variants, options.processes or 1)
+    for filename, output in izip(filenames, outputs):
+        open(filename, "wb").write(output)
+
+def main(options, args):
+    if options.cache:
+        use_decode_cache(options.cache, options.cache_size << 20)
+
+    if options.serve:
+        return serve(options)
+    elif options.connect:
+        return connect(options, args)
+    elif options.batch is not None and options.watch is not None:
+        return watch_batch(options, args)
+    elif options.batch is not None:
+        return process_batch(options, args)
+    elif options.variant:
+        return process_variants(options, args)
+
+    if len(args) >= 2 and args[0] != "-" and args[0] == args[1]:
+        print >>sys.stderr, "Cannot overwrite the save file, please use a different filename for the new save"
+        return
+
+    if len(args) < 1 or args[0] == "-":
+        input = sys.stdin
+    else:
+        input = open(args[0], "rb")
+
+    if len(args) < 2 or args[1] == "-":
+        output = sys.stdout
+    else:
+        output = open(args[1], "wb")
+
+    if options.export_items:
+        output = open(options.export_items, "w")
+    output.write(process_save(input.read(), options))
 
 if __name__ == "__main__":
     options, args = parse_args()
     try:
-        main(options, args)
+        failures = main(options, args)
     except:
         print >>sys.stderr, (
             "Something went wrong, but please ensure you have the latest "
@@ -1136,3 +3081,5 @@ if __name__ == "__main__":
         )
         print >>sys.stderr, repr(sys.argv)
         raise
+    if failures:
+        sys.exit(1)
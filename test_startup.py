@@ -0,0 +1,31 @@
+#! /usr/bin/env python
+
+# Checks that importing savefile leaves the modules it defers until first
+# use unloaded, so commands that don't need them don't wait for them
+
+import os
+import subprocess
+import sys
+import unittest
+
+
+deferred_modules = (
+    "glob", "json", "lzo", "multiprocessing", "numpy", "optparse", "random",
+    "socket", "SocketServer", "threading"
+)
+
+class StartupTest(unittest.TestCase):
+
+    def test_import_loads_no_deferred_modules(self):
+        code = "import sys, savefile; print ' '.join(sorted(sys.modules))"
+        output = subprocess.check_output(
+            [sys.executable, "-c", code],
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        )
+        loaded = set(output.split())
+        self.assertIn("savefile", loaded)
+        for name in deferred_modules:
+            self.assertNotIn(name, loaded)
+
+if __name__ == "__main__":
+    unittest.main()